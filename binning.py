@@ -5,10 +5,11 @@ import time
 import tracemalloc
 
 from resolution import resolution
-import external.OmniFold.modplot as modplot
+from histogramming import get_bin_indices, Histogram1D
 
 from plotting import plot_histograms1d
-from util import getLogger, load_dataset, get_variable_arr
+from datahandler import load_dataset
+from util import getLogger, get_variable_arr
 from util import read_dict_from_json, write_dict_to_json
 
 logger = getLogger('Binning')
@@ -25,7 +26,7 @@ def binning(**parsed_args):
     logger.info('Reading dataset {}'.format(parsed_args['inputs']))
     t_data_start = time.time()
 
-    ntuple = load_dataset(parsed_args['inputs'], weight_columns=[parsed_args['weight'], parsed_args['weight_mc']])
+    ntuple = load_dataset(parsed_args['inputs'], weight_columns=[parsed_args['weight'], parsed_args['weight_mc']], io_workers=parsed_args['io_workers'])
 
     t_data_end = time.time()
     logger.debug("Reading dataset took {:.2f} seconds".format(t_data_end-t_data_start))
@@ -89,18 +90,24 @@ def compute_bins(varname, data_reco_arr, data_truth_arr, weights_reco, weights_t
     # start with a histogram with finer bin width
     fineBins = np.linspace(xlim_low, xlim_high, nfinebins+1)
 
+    # bin indices in the fine bins, shared by the response and the histogram
+    indices_reco_fine = get_bin_indices(data_reco_arr, fineBins)
+    indices_truth_fine = get_bin_indices(data_truth_arr, fineBins)
+
     # resolution as a function of truth-level variable value
     figname_resol = os.path.join(outdir,'resolution_'+varname) if do_plot else None
     f_resol_var = resolution(data_reco_arr, data_truth_arr,
                              weights_reco*weights_truth,
                              fineBins, fineBins,
                              figname=figname_resol,
-                             xlabel=observable_dict[varname].get('xlabel'))
+                             xlabel=observable_dict[varname].get('xlabel'),
+                             indices_reco=indices_reco_fine,
+                             indices_truth=indices_truth_fine)
 
     # merge bins from left to right based on variable resolutions
     # as well as statistical uncertainties in reco bins
 
-    hist_fine, hist_fine_err = modplot.calc_hist(data_reco_arr, weights=weights_reco, bins=fineBins, density=False)[:2]
+    hist_fine, hist_fine_err = Histogram1D(fineBins).fill(data_reco_arr, weights_reco, indices_reco_fine).get_histogram()
 
     delta = observable_dict[varname].get('delta_res', 1.)
     max_bin_err = observable_dict[varname].get('max_bin_error', 0.05)
@@ -110,8 +117,8 @@ def compute_bins(varname, data_reco_arr, data_truth_arr, weights_reco, weights_t
     if do_plot:
         figname_var = os.path.join(outdir,'{}_binning'.format(varname))
         xlabel_var = observable_dict[varname].get('xlabel')
-        hist_reco, hist_reco_err = modplot.calc_hist(data_reco_arr, weights=weights_reco, bins=resBins, density=False)[:2]
-        hist_truth, hist_truth_err = modplot.calc_hist(data_truth_arr, weights=weights_truth, bins=resBins, density=False)[:2]
+        hist_reco, hist_reco_err = Histogram1D(resBins).fill(data_reco_arr, weights_reco).get_histogram()
+        hist_truth, hist_truth_err = Histogram1D(resBins).fill(data_truth_arr, weights_truth).get_histogram()
         plot_histograms1d(figname_var, resBins, [hist_reco, hist_truth], [hist_reco_err, hist_truth_err], labels=['Reco', 'Truth'], xlabel=xlabel_var,plottypes=['g','h'], marker='+')
 
     return resBins
@@ -192,6 +199,8 @@ if __name__ == "__main__":
                         help="name of MC weight")
     parser.add_argument('--nfinebins', default=100, type=int,
                         help="number of fine bins to start with")
+    parser.add_argument('--io-workers', dest='io_workers', type=int, default=1,
+                        help="Number of threads for reading input files")
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help="Verbosity level")
 
@@ -0,0 +1,170 @@
+import numpy as np
+from expressions import get_selection_branches, evaluate_selection
+from expressions import get_selection_cuts, may_pass_cuts
+
+# Input backends for HDF5 and Parquet files
+#
+# The readers have the same interface as read_npz_header and read_npz_into in
+# datahandler.py. Arguments allow_pickle and encoding are only there for
+# compatibility and not used.
+#
+# HDF5 files can either contain a compound dataset named array_name ('arr_0'
+# by default), or one 1D dataset per branch at the top level of the file.
+#
+# h5py and pyarrow are only imported when such files are read.
+
+def _import_h5py():
+    try:
+        import h5py
+    except ImportError:
+        raise RuntimeError("h5py is needed to read HDF5 files")
+    return h5py
+
+def _import_parquet():
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("pyarrow is needed to read Parquet files")
+    return pq
+
+def _fill_from_blocks(blocks, out, selection=None):
+    """
+    Fill the structured array out from blocks of rows
+    blocks: iterable of functions that return a dictionary of arrays given a
+            list of column names
+    If selection is provided, the columns needed for the selection are read
+    first, and the block is skipped if no event in it passes the selection
+    Return the number of events written
+    """
+    names = list(out.dtype.names)
+    names_sel = get_selection_branches(selection) if selection else []
+
+    nout = 0
+    for read_block in blocks:
+        if selection:
+            arrs_sel = read_block(names_sel)
+            passed = evaluate_selection(selection, lambda vname: arrs_sel[vname])
+            nselected = np.count_nonzero(passed)
+            if nselected == 0:
+                continue
+
+            arrs = read_block(names)
+            for vname in names:
+                out[vname][nout:nout+nselected] = arrs[vname][passed]
+        else:
+            arrs = read_block(names)
+            nselected = len(arrs[names[0]])
+            for vname in names:
+                out[vname][nout:nout+nselected] = arrs[vname]
+
+        nout += nselected
+
+    return nout
+
+def _check_fields(out, dtype, file_name):
+    for vname in out.dtype.names:
+        if not vname in dtype.names:
+            raise RuntimeError("Unknown variable name {} in {}".format(vname, file_name))
+
+###########
+# HDF5
+def _get_hdf5_fields(h5file, array_name):
+    # return the compound dataset if there is one, otherwise the file itself
+    # together with the dtype and the number of events
+    if array_name in h5file and h5file[array_name].dtype.names:
+        dset = h5file[array_name]
+        return dset, dset.dtype, dset.shape[0]
+    else:
+        dsets = {name : d for name, d in h5file.items() if getattr(d, 'ndim', None) == 1}
+        if not dsets:
+            raise RuntimeError("No array {} or 1D datasets found in {}".format(array_name, h5file.filename))
+
+        nevents = len(next(iter(dsets.values())))
+        for name, d in dsets.items():
+            if len(d) != nevents:
+                raise RuntimeError("Dataset {} in {} has {} entries instead of {}".format(name, h5file.filename, len(d), nevents))
+
+        dtype = np.dtype([(name, d.dtype) for name, d in dsets.items()])
+        return h5file, dtype, nevents
+
+def read_hdf5_header(file_name, array_name='arr_0'):
+    """
+    Return the shape, the memory order and the dtype of the events stored in
+    an HDF5 file without reading them
+    """
+    h5py = _import_h5py()
+    with h5py.File(file_name, 'r') as f:
+        dtype, nevents = _get_hdf5_fields(f, array_name)[1:]
+        return (nevents,), False, dtype
+
+def read_hdf5_into(file_name, out, array_name='arr_0', allow_pickle=True, encoding='bytes', chunk_size=100000, selection=None):
+    """
+    Read events from an HDF5 file into a preallocated structured array out
+    Only the fields of out are read, in blocks of chunk_size rows
+    """
+    h5py = _import_h5py()
+    with h5py.File(file_name, 'r') as f:
+        source, dtype, nevents = _get_hdf5_fields(f, array_name)
+        assert(out.shape == (nevents,))
+        _check_fields(out, dtype, file_name)
+
+        compound = isinstance(source, h5py.Dataset)
+
+        def get_block_reader(rows):
+            if compound:
+                return lambda names: {vname : source[rows, vname] for vname in names}
+            else:
+                return lambda names: {vname : source[vname][rows] for vname in names}
+
+        blocks = (get_block_reader(slice(istart, min(istart+chunk_size, nevents))) for istart in range(0, nevents, chunk_size))
+
+        return _fill_from_blocks(blocks, out, selection)
+
+###########
+# Parquet
+def read_parquet_header(file_name, array_name='arr_0'):
+    """
+    Return the shape, the memory order and the dtype of the events stored in
+    a Parquet file from its metadata
+    """
+    pq = _import_parquet()
+    pfile = pq.ParquetFile(file_name)
+    dtype = np.dtype([(field.name, field.type.to_pandas_dtype()) for field in pfile.schema_arrow])
+    return (pfile.metadata.num_rows,), False, dtype
+
+def read_parquet_into(file_name, out, array_name='arr_0', allow_pickle=True, encoding='bytes', chunk_size=100000, selection=None):
+    """
+    Read events from a Parquet file into a preallocated structured array out
+    Only the columns of out are read, one row group at a time
+    Row groups are skipped without reading them if their min/max statistics
+    rule out the comparisons combined with & in the selection, e.g.
+    "mttReco > 500". Otherwise, row groups without any event passing the
+    selection are skipped after reading the columns the selection depends on
+    """
+    pq = _import_parquet()
+    pfile = pq.ParquetFile(file_name)
+    assert(out.shape == (pfile.metadata.num_rows,))
+    _check_fields(out, read_parquet_header(file_name)[2], file_name)
+
+    def get_block_reader(igroup):
+        def read_block(names):
+            table = pfile.read_row_group(igroup, columns=names)
+            return {vname : table.column(vname).to_numpy() for vname in names}
+        return read_block
+
+    cuts = get_selection_cuts(selection) if selection else []
+    columns_index = {pfile.metadata.schema.column(icol).path : icol for icol in range(pfile.metadata.num_columns)}
+
+    def get_min_max(igroup, vname):
+        if not vname in columns_index:
+            return None
+        stats = pfile.metadata.row_group(igroup).column(columns_index[vname]).statistics
+        if stats is None or not stats.has_min_max:
+            return None
+        return stats.min, stats.max
+
+    igroups = [igroup for igroup in range(pfile.num_row_groups) if may_pass_cuts(cuts, lambda vname: get_min_max(igroup, vname))]
+
+    blocks = (get_block_reader(igroup) for igroup in igroups)
+
+    return _fill_from_blocks(blocks, out, selection)
@@ -77,15 +77,16 @@ def compare(result_dirs, labels, f_plot, plot_label, sim_samples,
     vars_det = [] # not used
 
     # load data
+    # branches are only read when they are first needed
     print("Load datasets")
     data_sim = []
     if not isinstance(sim_samples, list) or len(sim_samples)==1:
         # all unfolding results use the same datasets
-        dh = DataHandler(sim_samples, variable_names=vars_mc)
+        dh = DataHandler(sim_samples, variable_names=vars_mc, lazy=True)
         data_sim = [dh] * len(result_dirs)
     elif len(sim_samples)==len(result_dirs):
         for sample, rdir in zip(sim_samples, result_dirs):
-            data_sim.append(DataHandler(sample, variable_names=vars_mc))
+            data_sim.append(DataHandler(sample, variable_names=vars_mc, lazy=True))
     else:
         raise RuntimeError("Sample Error")
     #data_truth = DataHandler(obs_samples, variable_names=vars_mc) if obs_samples else None
@@ -98,12 +99,18 @@ def compare(result_dirs, labels, f_plot, plot_label, sim_samples,
     if not os.path.isdir(outdir):
         os.makedirs(outdir)
 
+    # truth-level bin edges
+    bins_dict = {varname : get_bins(varname, bin_config) for varname in observables}
+
+    # histograms of all observables in one pass over the events for each result
+    print("Fill histograms")
+    for uf in unfolders:
+        uf.fill_histograms([(observable_dict[varname], None, bins_dict[varname]) for varname in observables])
+
     for varname in observables:
         print(varname)
         varConfig = observable_dict[varname]
-
-        # truth-level bin edges
-        bins_mc = get_bins(varname, bin_config)
+        bins_mc = bins_dict[varname]
 
         # do plot
         figname = os.path.join(outdir, plot_label+'_'+varname)
@@ -1,26 +1,162 @@
+import os
+import copy
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
-from util import parse_input_name, normalize_histogram
-# for now
-import external.OmniFold.modplot as modplot
+from util import parse_input_name
+from util import read_dict_from_json, write_dict_to_json
+from kinematics import is_kinematic_variable, get_kinematic_components, compute_kinematic_variable
+from expressions import is_expression, get_expression_branches, evaluate_expression
+from expressions import get_selection_branches, evaluate_selection
+from sharedstore import get_dataset_key, attach_column, publish_column
+from histogramming import get_flow_bin_indices, get_bin_index_type, Histogram1D
+from backends import read_hdf5_header, read_hdf5_into, read_parquet_header, read_parquet_into
 
-def load_dataset(file_names, array_name='arr_0', allow_pickle=True, encoding='bytes', weight_columns=[]):
+def read_npz_header(file_name, array_name='arr_0'):
     """
-    Load and return a structured numpy array from a list of npz files
+    Return the shape, the memory order and the dtype of an array stored in an
+    npz file without reading the array itself
+    """
+    with zipfile.ZipFile(file_name) as zf:
+        with zf.open(array_name+'.npy') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                return np.lib.format.read_array_header_1_0(f)
+            else:
+                return np.lib.format.read_array_header_2_0(f)
+
+def _readinto_full(f, buf, file_name=''):
+    # keep reading from f until the byte buffer buf is filled
+    nread = 0
+    while nread < buf.nbytes:
+        n = f.readinto(buf[nread:])
+        if not n:
+            raise RuntimeError('Unexpected end of array in {}'.format(file_name))
+        nread += n
+
+def read_npz_into(file_name, out, array_name='arr_0', allow_pickle=True, encoding='bytes', chunk_size=100000, selection=None):
+    """
+    Read the array stored in an npz file directly into a preallocated array out
+    If out only contains a subset of the fields in the file, or the fields are
+    in another order, the array is streamed from the file in chunks of
+    chunk_size rows and the fields of out are copied by name
+    If selection is provided, it is evaluated on every chunk and only the
+    selected events are written to the beginning of out
+    Return the number of events written
+    """
+    with zipfile.ZipFile(file_name) as zf:
+        with zf.open(array_name+'.npy') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            assert(shape == out.shape)
+
+            if not dtype.hasobject and out.flags.c_contiguous:
+                if dtype == out.dtype and not selection:
+                    # copy the raw bytes into the output buffer
+                    _readinto_full(f, out.view(np.uint8), file_name)
+                    return len(out)
+                elif dtype.names and out.dtype.names:
+                    # field projection
+                    for vname in out.dtype.names:
+                        if not vname in dtype.names:
+                            raise RuntimeError("Unknown variable name {}".format(vname))
+
+                    chunk = np.empty(min(chunk_size, len(out)), dtype=dtype)
+                    nout = 0
+                    for istart in range(0, len(out), len(chunk)):
+                        nrows = min(len(chunk), len(out)-istart)
+                        _readinto_full(f, chunk[:nrows].view(np.uint8), file_name)
+
+                        chunk_i = chunk[:nrows]
+                        if selection:
+                            chunk_i = chunk_i[evaluate_selection(selection, lambda vname: chunk_i[vname])]
+
+                        for vname in out.dtype.names:
+                            out[vname][nout:nout+len(chunk_i)] = chunk_i[vname]
+                        nout += len(chunk_i)
+                    return nout
+
+    # otherwise let numpy read and convert the array
+    npzfile = np.load(file_name, allow_pickle=allow_pickle, encoding=encoding)
+    arr = npzfile[array_name]
+    if selection:
+        arr = arr[evaluate_selection(selection, lambda vname: arr[vname])]
+    if out.dtype.names:
+        for vname in out.dtype.names:
+            out[vname][:len(arr)] = arr[vname]
+    else:
+        out[:len(arr)] = arr
+    npzfile.close()
+    return len(arr)
+
+def get_input_backend(file_name):
+    """
+    Return the header and the array readers for a file based on its extension
+    """
+    ext = os.path.splitext(file_name)[1].lower()
+    if ext in ['.h5', '.hdf5']:
+        return read_hdf5_header, read_hdf5_into
+    elif ext in ['.parquet', '.pq']:
+        return read_parquet_header, read_parquet_into
+    else:
+        return read_npz_header, read_npz_into
+
+def load_dataset(file_names, array_name='arr_0', allow_pickle=True, encoding='bytes', weight_columns=[], variable_names=None, io_workers=1, selection=None):
+    """
+    Load and return a structured numpy array from a list of npz, HDF5 or Parquet files
+    The output array is allocated once based on the array headers of all files
+    and then filled in place file by file
+    If variable_names is provided, only these fields are read into the output
+    If io_workers > 1, files are decompressed concurrently by a thread pool,
+    each one into its own slice of the output
+    If selection is provided, only events passing it are kept. It is evaluated
+    chunk by chunk while reading, so rejected events are never copied.
     """
-    data = None
     if not isinstance(file_names, list):
         file_names = [file_names]
     if not isinstance(weight_columns, list):
         weight_columns = [weight_columns]
 
+    # read array headers to determine the size of the output
+    nevents_list = []
+    dtype = None
     for fname in file_names:
-        fn, rwfactor = parse_input_name(fname)
+        fn = parse_input_name(fname)[0]
 
-        npzfile = np.load(fn, allow_pickle=allow_pickle, encoding=encoding)
-        di = npzfile[array_name]
-        if len(di)==0:
+        read_header = get_input_backend(fn)[0]
+        shape, fortran_order, dtype_i = read_header(fn, array_name)
+        if len(shape)==0 or shape[0]==0:
             raise RuntimeError('There is no events in input file {}'.format(fname))
+        nevents_list.append(shape[0])
+
+        if dtype is None:
+            dtype = dtype_i
+        elif set(dtype_i.names) != set(dtype.names):
+            # the fields are read by name, so their order may differ
+            raise RuntimeError('Fields in input file {} differ from those in {}'.format(fname, file_names[0]))
+
+    if variable_names:
+        # only keep the requested fields
+        variable_names = list(dict.fromkeys(variable_names)) # remove duplicates
+        for vname in variable_names:
+            if not vname in dtype.names:
+                raise RuntimeError("Unknown variable name {}".format(vname))
+        dtype = np.dtype([(vname, dtype.fields[vname][0]) for vname in variable_names])
+
+    data = np.empty(sum(nevents_list), dtype=dtype)
+
+    def fill_slice(fname, istart, nevents):
+        fn, rwfactor = parse_input_name(fname)
+
+        di = data[istart:istart+nevents]
+        read_into = get_input_backend(fn)[1]
+        nselected = read_into(fn, di, array_name, allow_pickle, encoding, selection=selection)
+        di = di[:nselected]
 
         # rescale total event weights for this input file
         if rwfactor != 1.:
@@ -31,81 +167,602 @@ def load_dataset(file_names, array_name='arr_0', allow_pickle=True, encoding='by
                     print('Unknown field name {}'.format(wname))
                     continue
 
-        if data is None:
-            data = di
-        else:
-            data  = np.concatenate([data, di])
-        npzfile.close()
+        return nselected
+
+    istarts = np.cumsum([0]+nevents_list[:-1])
+
+    if io_workers > 1 and len(file_names) > 1:
+        with ThreadPoolExecutor(max_workers=io_workers) as executor:
+            nselected_list = list(executor.map(fill_slice, file_names, istarts, nevents_list))
+    else:
+        nselected_list = [fill_slice(fname, istart, nevents) for fname, istart, nevents in zip(file_names, istarts, nevents_list)]
+
+    if selection:
+        # move the selected events of each file next to each other
+        iout = 0
+        for istart, nselected in zip(istarts, nselected_list):
+            if iout != istart:
+                data[iout:iout+nselected] = data[istart:istart+nselected]
+            iout += nselected
+
+        # release the unused memory at the end
+        data.resize(iout, refcheck=False)
 
     return data
 
+# Columnar cache
+# A cache directory contains one raw .npy file per branch plus a json manifest
+# The .npy files can be memory-mapped so that only the branches that are
+# actually used are read from disk
+CACHE_MANIFEST = 'manifest.json'
+
+def is_columnar_cache(path):
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path, CACHE_MANIFEST))
+
+def write_columnar_cache(file_names, cache_dir, array_name='arr_0', buffer_size=2**28):
+    """
+    Convert a list of npz files into a columnar cache in cache_dir
+    Event weights are stored as they are. Reweighting factors given in the
+    input names (e.g. 'sample.npz*0.5') are not applied.
+    The column files are memory-mapped and filled file by file. From each
+    input file, as many branches as fit in buffer_size bytes are read at a
+    time, so the whole dataset is never held in memory. npz files with
+    object fields can only be loaded as a whole, which is done once per file.
+    """
+    if not isinstance(file_names, list):
+        file_names = [file_names]
+    file_names = [parse_input_name(fname)[0] for fname in file_names]
+
+    # read array headers to determine the size of the columns
+    nevents_list = []
+    dtype_list = []
+    dtype = None
+    for fn in file_names:
+        shape, fortran_order, dtype_i = get_input_backend(fn)[0](fn, array_name)
+        nevents_list.append(shape[0])
+        dtype_list.append(dtype_i)
+        if dtype is None:
+            dtype = dtype_i
+        elif set(dtype_i.names) != set(dtype.names):
+            raise RuntimeError('Fields in input file {} differ from those in {}'.format(fn, file_names[0]))
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    fields = {}
+    columns = {}
+    for vname in dtype.names:
+        if dtype[vname].hasobject:
+            # variable-length branches cannot be memory-mapped
+            print('Skip field {} of object type'.format(vname))
+            continue
+
+        columns[vname] = np.lib.format.open_memmap(os.path.join(cache_dir, vname+'.npy'), mode='w+', dtype=dtype[vname], shape=(sum(nevents_list),))
+        fields[vname] = dtype[vname].str
+
+    istart = 0
+    for fn, nevents, dtype_i in zip(file_names, nevents_list, dtype_list):
+        read_into = get_input_backend(fn)[1]
+
+        if read_into is read_npz_into and dtype_i.hasobject:
+            # numpy loads the whole array to read any field of it
+            # load it once and write all columns from it
+            with np.load(fn, allow_pickle=True, encoding='bytes') as npzfile:
+                arr = npzfile[array_name]
+                for vname in columns:
+                    columns[vname][istart:istart+nevents] = arr[vname]
+                del arr
+
+            istart += nevents
+            continue
+
+        # groups of branches whose arrays for this file fit in the buffer
+        groups = [[]]
+        group_size = 0
+        for vname in columns:
+            nbytes = nevents * columns[vname].itemsize
+            if groups[-1] and group_size + nbytes > buffer_size:
+                groups.append([])
+                group_size = 0
+            groups[-1].append(vname)
+            group_size += nbytes
+
+        for group in groups:
+            # only the fields of the group are read from the file
+            buf = np.empty(nevents, dtype=[(vname, columns[vname].dtype) for vname in group])
+            read_into(fn, buf, array_name)
+            for vname in group:
+                columns[vname][istart:istart+nevents] = buf[vname]
+            del buf
+
+        istart += nevents
+
+    for arr in columns.values():
+        arr.flush()
+
+    manifest = {'nevents': istart, 'fields': fields, 'sources': file_names}
+    write_dict_to_json(manifest, os.path.join(cache_dir, CACHE_MANIFEST))
+
+    return manifest
+
+def read_columnar_cache(cache_dir, variable_names=None, mmap_mode='r'):
+    """
+    Return a dictionary of memory-mapped column arrays and the number of events
+    from a columnar cache directory
+    """
+    manifest = read_dict_from_json(os.path.join(cache_dir, CACHE_MANIFEST))
+    fields = manifest['fields']
+
+    if not variable_names:
+        variable_names = list(fields)
+
+    columns = {}
+    for vname in variable_names:
+        if not vname in fields:
+            raise RuntimeError("Unknown variable name {}".format(vname))
+
+        columns[vname] = np.load(os.path.join(cache_dir, vname+'.npy'), mmap_mode=mmap_mode)
+        assert(len(columns[vname]) == manifest['nevents'])
+
+    return columns, manifest['nevents']
+
+def load_columnar_caches(file_names, variable_names=None, weight_columns=[], mmap_mode='r', selection=None, chunk_size=100000):
+    """
+    Load columns from a list of columnar caches
+    If there is only one cache, the columns are memory-mapped. Otherwise they are
+    concatenated in memory. Weight columns are copied if they need rescaling.
+    If selection is provided, only the selected events are copied into memory
+    """
+    if not isinstance(file_names, list):
+        file_names = [file_names]
+    if not isinstance(weight_columns, list):
+        weight_columns = [weight_columns]
+
+    columns_list = []
+    nevents = 0
+    for fname in file_names:
+        fn, rwfactor = parse_input_name(fname)
+
+        columns, ncache = read_columnar_cache(fn, variable_names, mmap_mode)
+        if ncache==0:
+            raise RuntimeError('There is no events in input file {}'.format(fname))
+
+        if selection:
+            # evaluate the selection chunk by chunk on the memory-mapped columns
+            columns_sel = read_columnar_cache(fn, get_selection_branches(selection), mmap_mode)[0]
+            passed = np.empty(ncache, dtype=bool)
+            for istart in range(0, ncache, chunk_size):
+                rows = slice(istart, min(istart+chunk_size, ncache))
+                passed[rows] = evaluate_selection(selection, lambda vname: columns_sel[vname][rows])
+
+            columns = {vname : arr[passed] for vname, arr in columns.items()}
+            ncache = np.count_nonzero(passed)
+
+        # rescale total event weights for this cache
+        if rwfactor != 1.:
+            for wname in weight_columns:
+                if wname in columns:
+                    columns[wname] = columns[wname] * rwfactor
+
+        columns_list.append(columns)
+        nevents += ncache
+
+    if len(columns_list) == 1:
+        return columns_list[0], nevents
+    else:
+        columns = {vname : np.concatenate([c[vname] for c in columns_list]) for vname in columns_list[0]}
+        return columns, nevents
+
+def read_dataset_fields(file_names, array_name='arr_0'):
+    """
+    Return the names of the branches available in the input files without
+    reading any of them
+    """
+    if not isinstance(file_names, list):
+        file_names = [file_names]
+    fn = parse_input_name(file_names[0])[0]
+
+    if is_columnar_cache(fn):
+        return list(read_dict_from_json(os.path.join(fn, CACHE_MANIFEST))['fields'])
+    else:
+        read_header = get_input_backend(fn)[0]
+        return list(read_header(fn, array_name)[2].names)
+
+# momentum components computed from pt and an angle, e.g. 'th_px' from
+# 'th_pt' and 'th_phi'
+MOMENTUM_COMPONENTS = {'_px': '_phi', '_py': '_phi', '_pz': '_eta'}
+
+def get_derived_branches(variable):
+    """
+    Return the list of branches a derived variable is computed from
+    """
+    if is_kinematic_variable(variable):
+        return get_kinematic_components(variable)
+    elif is_expression(variable):
+        return get_expression_branches(variable)
+
+    for comp, angle in MOMENTUM_COMPONENTS.items():
+        if comp in variable:
+            return [variable.replace(comp, '_pt'), variable.replace(comp, angle)]
+
+    raise RuntimeError("Unknown derived variable {}".format(variable))
+
 class DataHandler(object):
     def __init__(self, filepaths, wname='w', truth_known=True,
-                 variable_names=None, vars_dict={}):
+                 variable_names=None, vars_dict={}, chunk_size=None,
+                 io_workers=1, vtype='float32', wtype='float64',
+                 precompute=[], derived_cache_size=16, selection=None,
+                 lazy=False, shared=False, bin_index_cache_size=32):
         self.weight_name = wname # name of event weights
         self.truth_known = truth_known
+        # precision policy
+        # type of variable arrays (features)
+        self.vtype = np.dtype(vars_dict.get('vtype', vtype))
+        # type of event weights
+        self.wtype = np.dtype(wtype)
+        # number of events per row block in the chunked mode
+        # if None, operations are done on the full arrays at once
+        # combined with columnar caches, only one block of the memory-mapped
+        # columns is paged in at a time
+        self.chunk_size = chunk_size
 
-        # load data from npz files to numpy array
-        tmpDataArr = load_dataset(filepaths, weight_columns=wname)
-        assert(tmpDataArr is not None)
+        if not isinstance(filepaths, list):
+            filepaths = [filepaths]
+        self.filepaths = filepaths
+        self.io_workers = io_workers
+        self.selection = selection
 
-        if not variable_names:
-            # if no variable name list is provided, read everything
-            variable_names = tmpDataArr.dtype.names
-        else:
+        # if lazy, files are only opened and branches are only read when they
+        # are first accessed. The first access reads all branches listed in
+        # variable_names that have not been read yet in one pass over the
+        # files. Branches that have been read are kept.
+        self.lazy = lazy
+        self._lazy_branch_names = None
+
+        # if shared, columns are published in named shared memory and reused
+        # by other processes reading the same inputs with the same selection
+        # (see sharedstore.py). Shared columns are read-only.
+        self.shared = shared
+        self._dataset_key = None
+
+        # self.data is a dictionary of 1D arrays with variable names as keys
+        self.data = {}
+        self.nevents = None
+        self._sumw = None
+        self._available_branches = None
+
+        # cache of derived variable arrays, e.g. '_px' computed from '_pt' and '_phi'
+        # the least recently used array is evicted if there are more than
+        # derived_cache_size of them
+        self.derived_cache = OrderedDict()
+        self.derived_cache_size = derived_cache_size
+
+        # cache of bin indices of variables for histogramming
+        # keyed by the variable name and the bin edges
+        # the least recently used entry is evicted if there are more than
+        # bin_index_cache_size of them
+        self.bin_index_cache = OrderedDict()
+        self.bin_index_cache_size = bin_index_cache_size
+
+        precompute = list(precompute)
+        branch_names = None
+        if variable_names:
             # add wname to the list
             if wname and not wname in variable_names:
                 variable_names.append(wname)
 
-            # check all variable names are available
+            # variables that are computed from other branches at load time
+            # e.g. 'tt:mtt' from the top quark four-vector components
+            # or expressions such as '=log(th_pt)'
+            # read the branches they depend on instead
+            branch_names = []
+            # declared derived variables, e.g. 'th_px'
+            for vname in precompute:
+                branch_names += get_derived_branches(vname)
+
             for vname in variable_names:
-                if not vname in tmpDataArr.dtype.names:
-                    raise RuntimeError("Unknown variable name {}".format(vname))
+                if vname in precompute:
+                    continue
+                elif is_kinematic_variable(vname):
+                    precompute.append(vname)
+                    branch_names += get_kinematic_components(vname)
+                elif is_expression(vname):
+                    precompute.append(vname)
+                    branch_names += get_expression_branches(vname)
+                else:
+                    branch_names.append(vname)
 
-        # convert all fields to float
-        dtypes = [(vname, vars_dict.get('vtype','float')) for vname in variable_names]
-        self.data = np.array(tmpDataArr[variable_names], dtype=dtypes)
+            branch_names = list(dict.fromkeys(branch_names))
 
+        if self.shared:
+            self._dataset_key = get_dataset_key(self.filepaths, self.selection)
+
+        if self.lazy:
+            # derived variables are computed from the branches on first access
+            self._lazy_branch_names = branch_names
+            return
+
+        if self.shared:
+            branch_names = self._attach_shared_columns(variable_names, precompute)
+
+        if branch_names is None or branch_names:
+            self._read_branches(branch_names)
+
+        # compute the declared derived variables once and keep them as columns
+        # evaluate in blocks to avoid full-size temporary arrays
+        for vname in precompute:
+            if not vname in self.data:
+                arr = np.empty(self.nevents, dtype=self.vtype)
+                for rows in self.iter_chunks(self.chunk_size or 65536):
+                    arr[rows] = self._compute_derived_arr(vname, rows)
+                self.data[vname] = arr
+
+        # drop the branches that are only read to compute other variables
+        if variable_names:
+            for vname in branch_names:
+                if not vname in variable_names and vname in self.data:
+                    del self.data[vname]
+
+        if self.shared:
+            # publish the columns read or computed by this process
+            # read-only ones are either shared already or memory-mapped from
+            # columnar caches, which are shared via the page cache anyway
+            for vname, arr in self.data.items():
+                if arr.flags.writeable:
+                    self.data[vname] = publish_column(self._dataset_key, vname, arr)
+
+    def has_inputs(self, filepaths, selection=None):
+        """
+        Return True if the handler is built from the same input files with the
+        same reweighting factors and the same event selection
+        """
+        if not isinstance(filepaths, list):
+            filepaths = [filepaths]
+
+        def normalize(fps):
+            return [(os.path.abspath(fn), rwfactor) for fn, rwfactor in map(parse_input_name, fps)]
+
+        return selection == self.selection and normalize(filepaths) == normalize(self.filepaths)
+
+    def share(self, truth_known=True):
+        """
+        Return a new handler of the same inputs that shares the column storage
+        with this one
+        The shared columns are set read-only. Event weights are copy-on-write:
+        get_weights always returns a new array.
+        """
+        other = copy.copy(self)
+        other.truth_known = truth_known
+
+        # same dictionary, so columns read lazily later are shared as well
+        other.data = self.data
+        for arr in self.data.values():
+            arr.flags.writeable = False
+
+        if other.nevents is None and other.data:
+            other.nevents = len(next(iter(other.data.values())))
+
+        # derived arrays and bin indices are cached per handler
+        other.derived_cache = OrderedDict()
+        other.bin_index_cache = OrderedDict()
+
+        return other
+
+    def _attach_shared_columns(self, variable_names, precompute):
+        """
+        Attach to the columns already published in shared memory
+        Return the list of branches that still need to be read
+        """
+        if variable_names is None:
+            variable_names = read_dataset_fields(self.filepaths)
+
+        # derived variables only need their components if they are not shared
+        needed = []
+        for vname in precompute:
+            arr = attach_column(self._dataset_key, vname, self.vtype)
+            if arr is not None:
+                self._set_shared_column(vname, arr)
+            else:
+                needed += get_derived_branches(vname)
+
+        for vname in variable_names:
+            if is_kinematic_variable(vname) or is_expression(vname):
+                continue
+
+            dtype = self._get_column_type(vname)
+            arr = attach_column(self._dataset_key, vname, dtype)
+            if arr is None:
+                needed.append(vname)
+            else:
+                self._set_shared_column(vname, arr)
+
+        return [vname for vname in dict.fromkeys(needed) if not vname in self.data]
+
+    def _set_shared_column(self, vname, arr):
+        assert(self.nevents is None or self.nevents == len(arr))
+        self.nevents = len(arr)
+        self.data[vname] = arr
+
+    def _read_branches(self, branch_names=None):
+        """
+        Read branches from the input files into self.data
+        If branch_names is None, read everything
+        """
+        wnames = [self.weight_name] if self.weight_name and (branch_names is None or self.weight_name in branch_names) else []
+
+        if all(is_columnar_cache(parse_input_name(fp)[0]) for fp in self.filepaths):
+            # memory-map the columns from the caches
+            columns, nevents = load_columnar_caches(self.filepaths, branch_names, weight_columns=wnames, selection=self.selection)
+        else:
+            # load data from npz files to numpy array
+            # only the fields in branch_names are read if provided
+            tmpDataArr = load_dataset(self.filepaths, weight_columns=wnames,
+                                      variable_names=branch_names,
+                                      io_workers=self.io_workers,
+                                      selection=self.selection)
+            assert(tmpDataArr is not None)
+
+            if not branch_names:
+                # if no variable name list is provided, read everything
+                branch_names = tmpDataArr.dtype.names
+
+            columns = {vname : tmpDataArr[vname] for vname in branch_names}
+            nevents = len(tmpDataArr)
+
+        assert(self.nevents is None or self.nevents == nevents)
+        self.nevents = nevents
+
+        # convert fields to self.vtype and the weight field to self.wtype
+        # contiguous columns (e.g. memory-mapped ones) of the type are not copied
+        # in the chunked mode, memory-mapped columns of another type are kept
+        # as they are and converted block by block in get_variable_arr
+        for vname, arr in columns.items():
+            dtype = self._get_column_type(vname)
+            if arr.dtype == dtype and arr.flags.c_contiguous:
+                self.data[vname] = arr
+            elif self.chunk_size and isinstance(arr, np.memmap):
+                self.data[vname] = arr
+            else:
+                self.data[vname] = np.array(arr, dtype=dtype)
+
+    def _get_column_type(self, vname):
+        return self.wtype if vname == self.weight_name else self.vtype
+
+    def _read_lazy_branches(self, variable):
+        """
+        Read variable together with the branches declared in the constructor
+        that have not been read yet, in one pass over the input files
+        In the shared mode, columns already published are attached instead,
+        and the ones read are published.
+        """
+        names = [vname for vname in (self._lazy_branch_names or []) if not vname in self.data]
+        if not variable in names and not variable in self.data:
+            names.append(variable)
+
+        if self.shared:
+            names = self._attach_shared_columns(names, [])
+
+        if not names:
+            return
+
+        self._read_branches(names)
+
+        if self.shared:
+            # memory-mapped columns are not copied, as in __init__
+            for vname in names:
+                if self.data[vname].flags.writeable:
+                    self.data[vname] = publish_column(self._dataset_key, vname, self.data[vname])
+
+    def _get_available_branches(self):
+        if self._available_branches is None:
+            self._available_branches = set(read_dataset_fields(self.filepaths))
+        return self._available_branches
+
+    @property
+    def sumw(self):
         # sum of event weights
-        self.sumw = len(self.data)
-        if wname and wname in self.data.dtype.names:
-            self.sumw = self.data[wname].sum()
+        # always accumulated in double precision
+        if self._sumw is None:
+            if self.weight_name:
+                self._sumw = sum(self.get_variable_arr(self.weight_name, rows).sum(dtype=np.float64) for rows in self.iter_chunks())
+            else:
+                self._sumw = self.get_nevents()
+        return self._sumw
 
     def get_nevents(self):
-        return len(self.data)
+        if self.nevents is None and self.data:
+            # columns may have been read by a handler sharing the storage
+            self.nevents = len(next(iter(self.data.values())))
+
+        if self.nevents is None:
+            # the number of events is known once any branch is read
+            # read the event weights, which are needed in most cases anyway
+            vname = self.weight_name or read_dataset_fields(self.filepaths)[0]
+            if self.lazy:
+                self._read_lazy_branches(vname)
+            else:
+                self._read_branches([vname])
+        return self.nevents
+
+    def iter_chunks(self, chunk_size=None):
+        """
+        Iterate over row blocks of the dataset
+        Yield a slice object for each block
+        """
+        nevents = self.get_nevents()
+        chunk_size = chunk_size or self.chunk_size or nevents
+        for istart in range(0, nevents, chunk_size):
+            yield slice(istart, min(istart+chunk_size, nevents))
 
-    def get_variable_arr(self, variable):
+    def get_variable_arr(self, variable, rows=None):
         # return a view (NOT copy) of self.data if possible
         # otherwise, try to make a new array from self.data
-        # the output shape is (len(self.data), )
+        # the output shape is (self.nevents, )
+        # if rows is provided (e.g. a slice), only return those rows
 
-        if variable in self.data.dtype.names:
-            return self.data[variable]
+        if variable in self.data:
+            arr = self.data[variable] if rows is None else self.data[variable][rows]
+            # memory-mapped columns may be stored in another type
+            dtype = self._get_column_type(variable)
+            return arr if arr.dtype == dtype else arr.astype(dtype)
+        elif self.lazy and variable in self._get_available_branches():
+            # read the branch on first access
+            self._read_lazy_branches(variable)
+            return self.get_variable_arr(variable, rows)
+        elif variable in self.derived_cache:
+            # move to the most recently used end
+            self.derived_cache.move_to_end(variable)
+            if rows is None:
+                return self.derived_cache[variable]
+            else:
+                return self.derived_cache[variable][rows]
+        elif rows is not None:
+            # do not cache partial arrays
+            return self._compute_derived_arr(variable, rows)
+        else:
+            arr = self._compute_derived_arr(variable)
+            arr.flags.writeable = False
+
+            if self.derived_cache_size > 0:
+                self.derived_cache[variable] = arr
+                if len(self.derived_cache) > self.derived_cache_size:
+                    # evict the least recently used one
+                    self.derived_cache.popitem(last=False)
+
+            return arr
+
+    def _compute_derived_arr(self, variable, rows=None):
+        # ttbar kinematics from the top quark four-vectors
+        if is_kinematic_variable(variable):
+            return compute_kinematic_variable(variable, lambda vname: self.get_variable_arr(vname, rows))
+        # expressions of other variables
+        elif is_expression(variable):
+            return evaluate_expression(variable, lambda vname: self.get_variable_arr(vname, rows))
         # special cases
         elif '_px' in variable:
             var_pt = variable.replace('_px', '_pt')
             var_phi = variable.replace('_px', '_phi')
-            arr_pt = self.get_variable_arr(var_pt)
-            arr_phi = self.get_variable_arr(var_phi)
+            arr_pt = self.get_variable_arr(var_pt, rows)
+            arr_phi = self.get_variable_arr(var_phi, rows)
             return arr_pt * np.cos(arr_phi)
         elif '_py' in variable:
             var_pt = variable.replace('_py', '_pt')
             var_phi = variable.replace('_py', '_phi')
-            arr_pt = self.get_variable_arr(var_pt)
-            arr_phi = self.get_variable_arr(var_phi)
+            arr_pt = self.get_variable_arr(var_pt, rows)
+            arr_phi = self.get_variable_arr(var_phi, rows)
             return arr_pt * np.sin(arr_phi)
         elif '_pz' in variable:
             var_pt = variable.replace('_pz', '_pt')
             var_eta = variable.replace('_pz', '_eta')
-            arr_pt = self.get_variable_arr(var_pt)
-            arr_eta = self.get_variable_arr(var_eta)
+            arr_pt = self.get_variable_arr(var_pt, rows)
+            arr_eta = self.get_variable_arr(var_eta, rows)
             return arr_pt * np.sinh(arr_eta)
         else:
-            raise RuntimeError("Unknown variable {}. \nAvailable variable names: {}".format(variable, self.data.dtype.names))
+            raise RuntimeError("Unknown variable {}. \nAvailable variable names: {}".format(variable, list(self.data)))
 
     def get_weights(self, unweighted=False, bootstrap=False, normalize=False, rw_type=None, vars_dict={}):
         if unweighted or not self.weight_name:
-            return np.ones(len(self.data))
+            return np.ones(self.get_nevents(), dtype=self.wtype)
         else:
             # always return a copy of the original weight array in self.data
             weights = self.get_variable_arr(self.weight_name).copy()
@@ -115,37 +772,100 @@ class DataHandler(object):
             if rw_type is not None:
                 weights *= self._reweight_sample(rw_type, vars_dict)
 
-            # normalize to len(self.data)
+            # normalize to self.nevents
             if normalize:
-                weights /= np.mean(weights)
+                weights /= np.mean(weights, dtype=np.float64)
 
             if bootstrap:
                 weights *= np.random.poisson(1, size=len(weights))
 
             return weights
 
-    def get_dataset(self, features, label, standardize=False):
+    def get_dataset(self, features, label, standardize=False, out=None):
         """ features: a list of variable names
             label: int for class label
+            out: optional C-contiguous array of the shape (n_events, n_features)
+                 to write the features into, e.g. a slice of a larger array
             Return:
                 X: numpy array of the shape (n_events, n_features)
-                Y: numpy array for event label of the shape (n_events,)
+                Y: read-only int8 array for event label of the shape (n_events,)
         """
         # ndarray of shape (n_events, n_features) for training
-        X = np.vstack([self.get_variable_arr(varname) for varname in features]).T
+        # columns are written directly into the C-contiguous array
+        shape = (self.get_nevents(), len(features))
+        if out is None:
+            X = np.empty(shape, dtype=self.vtype)
+        else:
+            assert(out.shape == shape)
+            X = out
+
+        for i, varname in enumerate(features):
+            if self.chunk_size:
+                # only one block of each column is read at a time
+                for rows in self.iter_chunks(self.chunk_size):
+                    X[rows, i] = self.get_variable_arr(varname, rows)
+            else:
+                X[:, i] = self.get_variable_arr(varname)
 
         if standardize:
-            Xmean = np.mean(X, axis=0)
-            Xstd = np.std(X, axis=0)
-            X -= Xmean
-            X /= Xstd
+            # statistics are computed in double precision
+            if self.chunk_size:
+                Xmean, Xstd = self.get_mean_std(features)
+            else:
+                Xmean = np.mean(X, axis=0, dtype=np.float64)
+                Xstd = np.std(X, axis=0, dtype=np.float64)
+            X -= Xmean.astype(X.dtype)
+            X /= Xstd.astype(X.dtype)
 
         # label
-        Y = np.full(len(X), label)
+        # class index as in training. A broadcast view, so nothing is
+        # allocated per event
+        Y = np.broadcast_to(np.int8(label), (len(X),))
 
         return X, Y
 
+    def _accumulate_moments(self, variables, chunk_size=None):
+        """
+        Accumulate the means and the co-moment matrix of variables block by block
+        Blocks are merged with the pairwise update of Chan et al., which is
+        numerically stable for large numbers of events
+        Return n, mean of shape (n_vars,), comoment of shape (n_vars, n_vars)
+        """
+        n = 0
+        mean = np.zeros(len(variables))
+        comoment = np.zeros((len(variables), len(variables)))
+
+        for rows in self.iter_chunks(chunk_size):
+            X = np.vstack([self.get_variable_arr(varname, rows) for varname in variables]).astype(np.float64)
+            n_b = X.shape[1]
+            mean_b = X.mean(axis=1)
+            X -= mean_b[:,np.newaxis]
+            comoment_b = X @ X.T
+
+            delta = mean_b - mean
+            n_ab = n + n_b
+            mean += delta * n_b / n_ab
+            comoment += comoment_b + np.outer(delta, delta) * n * n_b / n_ab
+            n = n_ab
+
+        return n, mean, comoment
+
+    def get_mean_std(self, features, chunk_size=None):
+        """
+        Compute means and standard deviations of features block by block
+        """
+        n, mean, comoment = self._accumulate_moments(features, chunk_size)
+        std = np.sqrt(np.diag(comoment) / n)
+        return mean, std
+
     def get_correlations(self, variables):
+        if self.chunk_size:
+            # accumulate chunk by chunk
+            comoment = self._accumulate_moments(variables)[2]
+            norm = np.sqrt(np.diag(comoment))
+            correlations = pd.DataFrame(comoment / np.outer(norm, norm), index=variables, columns=variables)
+            return correlations
+
         df = pd.DataFrame({var:self.get_variable_arr(var) for var in variables}, columns=variables)
         correlations = df.corr()
         return correlations
@@ -153,31 +873,92 @@ class DataHandler(object):
     def get_histogram(self, variable, weights, bin_edges, normalize=False):
         """
         If weights is a 1D array of the same length as the variable array, return a histogram and its error
-        If weights is a 2D array or a list of 1D array, return a list of histograms and a list of their errors
-        """
-        if isinstance(weights, np.ndarray):
-            if weights.ndim == 1: # if weights is a 1D array
-                varr = self.get_variable_arr(variable)
-                # check the weight array length is the same as the variable array
-                assert(len(varr) == len(weights))
-                hist, hist_err = modplot.calc_hist(varr, weights=weights, bins=bin_edges, density=False)[:2]
-                if normalize:
-                    normalize_histogram(bin_edges, hist, hist_err)
-                return hist, hist_err
-            elif weights.ndim == 2: # make the 2D array into a list of 1D array
-                return self.get_histogram(variable, list(weights), bin_edges, normalize)
-            else:
-                raise RuntimeError("Only 1D or 2D array or a list of 1D array of weights can be processed.")
-        elif isinstance(weights, list): # if weights is a list of 1D array
-            hists, hists_err = [], []
-            for w in weights:
-                h, herr = self.get_histogram(variable, w, bin_edges, normalize)
-                hists.append(h)
-                hists_err.append(herr)
-            return hists, hists_err
-        else:
+        If weights is an array of the shape (..., n_events) or a list of 1D arrays, return arrays of histograms
+        and their errors of the shape (..., n_bins)
+        The variable is binned once for all weight vectors. In the chunked mode,
+        histograms are accumulated block by block.
+        """
+        if isinstance(weights, list):
+            weights = np.asarray(weights)
+
+        return self.get_histograms([(variable, bin_edges)], weights, normalize)[0]
+
+    def get_histograms(self, variables_bins, weights, normalize=False):
+        """
+        Histogram several variables with the same weights in one pass
+        variables_bins: list of (variable name, bin edges)
+        weights: array of the shape (n_events,) or (..., n_events)
+        Return a list of (histograms, errors), one for each variable, with
+        the same shapes as in get_histogram
+        """
+        histograms = self.accumulate_histograms(variables_bins, weights)
+        return [h.get_histogram(normalize) for h in histograms]
+
+    def accumulate_histograms(self, variables_bins, weights, histograms=None, rows=None):
+        """
+        Fill histogram accumulators of several variables with the same weights
+        variables_bins: list of (variable name, bin edges)
+        weights: array of the shape (n_events,) or (..., n_events)
+        histograms: list of Histogram1D to add to, one for each variable
+                    If None, new ones are created.
+        rows: only fill the events in this slice, e.g. the share of a worker,
+              in which case the last axis of weights is for these rows only
+        Return the list of Histogram1D, which can be merged with those filled
+        by other workers
+        The events are processed in blocks. Each block of weights is used for
+        all variables before moving on to the next one.
+        """
+        if not isinstance(weights, np.ndarray):
             raise RuntimeError("Unknown type of weights: {}".format(type(weights)))
 
+        rows = rows or slice(0, self.get_nevents())
+        istart, istop = rows.indices(self.get_nevents())[:2]
+        assert(weights.shape[-1] == istop - istart)
+
+        if histograms is None:
+            histograms = [Histogram1D(bin_edges, shape=weights.shape[:-1]) for _, bin_edges in variables_bins]
+
+        flow_indices_list = [self.get_flow_bin_indices(variable, bin_edges) for variable, bin_edges in variables_bins]
+
+        block_size = self.chunk_size or 65536
+        for ib in range(istart, istop, block_size):
+            block = slice(ib, min(ib+block_size, istop))
+            w = weights[..., block.start-istart:block.stop-istart]
+            for flow_indices, hist in zip(flow_indices_list, histograms):
+                hist.fill_flow_indices(flow_indices[block], w)
+
+        return histograms
+
+    def get_flow_bin_indices(self, variable, bin_edges):
+        """
+        Return the read-only array of the bin index of each event given the
+        bin edges, counting the underflow bin as 0 and the overflow bin as
+        n_bins+1, or -1 for nan
+        The arrays are cached, so histograms of the same variable and bins
+        only need a weighted bincount
+        """
+        bin_edges = np.asarray(bin_edges, dtype=np.float64)
+        key = (variable, bin_edges.tobytes())
+
+        if key in self.bin_index_cache:
+            # move to the most recently used end
+            self.bin_index_cache.move_to_end(key)
+            return self.bin_index_cache[key]
+
+        # compact integer type: 2 or 4 bytes per event
+        flow_indices = np.empty(self.get_nevents(), dtype=get_bin_index_type(len(bin_edges)+1))
+        for rows in self.iter_chunks():
+            flow_indices[rows] = get_flow_bin_indices(self.get_variable_arr(variable, rows if self.chunk_size else None), bin_edges)
+        flow_indices.flags.writeable = False
+
+        if self.bin_index_cache_size > 0:
+            self.bin_index_cache[key] = flow_indices
+            # evict the least recently used one
+            if len(self.bin_index_cache) > self.bin_index_cache_size:
+                self.bin_index_cache.popitem(last=False)
+
+        return flow_indices
+
     def _reweight_sample(self, rw_type, vars_dict):
         if not rw_type:
             return 1.
@@ -0,0 +1,175 @@
+import ast
+from functools import lru_cache
+import numpy as np
+
+# Derived variables defined as arithmetic expressions of existing branches
+#
+# In observable configs, such a variable is a string starting with '=', e.g.
+#   "branch_det": "=log(th_pt)", "branch_mc": "=log(th_pt_MC)"
+#   "branch_det": "=abs(th_y - tl_y)/2"
+#
+# Expressions are parsed and compiled once. Only numbers, branch names,
+# arithmetic and comparison operators and the functions below are allowed.
+#
+# Event selections are boolean expressions without the '=' prefix, e.g.
+#   "(mttReco > 500) & (abs(ystarReco) < 1)"
+# Use & and | instead of 'and' and 'or', with parentheses around comparisons.
+
+EXPRESSION_PREFIX = '='
+
+FUNCTIONS = {
+    'abs': np.abs,
+    'sqrt': np.sqrt,
+    'exp': np.exp,
+    'log': np.log,
+    'log10': np.log10,
+    'sin': np.sin,
+    'cos': np.cos,
+    'tan': np.tan,
+    'sinh': np.sinh,
+    'cosh': np.cosh,
+    'tanh': np.tanh,
+    'arctan2': np.arctan2,
+    'hypot': np.hypot,
+    'minimum': np.minimum,
+    'maximum': np.maximum,
+}
+
+ALLOWED_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Load,
+    ast.Constant, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd,
+    ast.Compare, ast.Gt, ast.GtE, ast.Lt, ast.LtE, ast.Eq, ast.NotEq,
+    ast.BitAnd, ast.BitOr, ast.Invert
+)
+
+def is_expression(variable):
+    return variable.startswith(EXPRESSION_PREFIX)
+
+@lru_cache(maxsize=None)
+def compile_expression(variable):
+    """
+    Parse and compile an expression variable
+    Return the code object and the list of branch names it depends on
+    """
+    expression = variable[len(EXPRESSION_PREFIX):].strip()
+
+    try:
+        tree = ast.parse(expression, mode='eval')
+    except SyntaxError as e:
+        raise RuntimeError("Invalid expression {}: {}".format(expression, e))
+
+    branches = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            raise RuntimeError("{} is not allowed in expression {}".format(type(node).__name__, expression))
+
+        if isinstance(node, ast.Call):
+            if not (isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS) or node.keywords:
+                raise RuntimeError("Unsupported function call in expression {}. \nAvailable functions: {}".format(expression, list(FUNCTIONS)))
+        elif isinstance(node, ast.Name) and not node.id in FUNCTIONS:
+            branches.append(node.id)
+
+    code = compile(tree, '<expression>', 'eval')
+
+    return code, list(dict.fromkeys(branches))
+
+def get_expression_branches(variable):
+    """
+    Return the list of branch names needed to evaluate an expression variable
+    """
+    return compile_expression(variable)[1]
+
+def evaluate_expression(variable, get_arr):
+    """
+    Evaluate an expression variable
+    get_arr: function that returns the array of a branch given its name
+    """
+    code, branches = compile_expression(variable)
+
+    namespace = dict(FUNCTIONS)
+    for bname in branches:
+        namespace[bname] = get_arr(bname)
+
+    return eval(code, {'__builtins__': {}}, namespace)
+
+def get_selection_branches(selection):
+    """
+    Return the list of branch names needed to evaluate an event selection
+    """
+    return get_expression_branches(EXPRESSION_PREFIX+selection)
+
+def evaluate_selection(selection, get_arr):
+    """
+    Evaluate an event selection
+    Return a boolean array that is True for the selected events
+    """
+    return np.asarray(evaluate_expression(EXPRESSION_PREFIX+selection, get_arr), dtype=bool)
+
+# comparison operators of a branch with a number, as seen from the branch
+COMPARISONS = {ast.Gt: '>', ast.GtE: '>=', ast.Lt: '<', ast.LtE: '<=', ast.Eq: '=='}
+FLIPPED_COMPARISONS = {'>': '<', '>=': '<=', '<': '>', '<=': '>=', '==': '=='}
+
+def _get_number(node):
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+        return float(node.value)
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        value = _get_number(node.operand)
+        if value is not None and isinstance(node.op, ast.USub):
+            value = -value
+        return value
+    return None
+
+@lru_cache(maxsize=None)
+def get_selection_cuts(selection):
+    """
+    Return the list of (branch name, operator, number) of the comparisons that
+    every selected event passes, i.e. those combined with & at the top level
+    of the selection, e.g. [('mttReco', '>', 500.)] for
+      "(mttReco > 500) & (abs(ystarReco) < 1)"
+    Other parts of the selection are ignored.
+    """
+    compile_expression(EXPRESSION_PREFIX+selection) # validate
+    tree = ast.parse(selection.strip(), mode='eval')
+
+    cuts = []
+    terms = [tree.body]
+    while terms:
+        node = terms.pop()
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.BitAnd):
+            terms += [node.left, node.right]
+        elif isinstance(node, ast.Compare) and len(node.ops) == 1 and type(node.ops[0]) in COMPARISONS:
+            op = COMPARISONS[type(node.ops[0])]
+            left, right = node.left, node.comparators[0]
+            if isinstance(left, ast.Name) and not left.id in FUNCTIONS and _get_number(right) is not None:
+                cuts.append((left.id, op, _get_number(right)))
+            elif isinstance(right, ast.Name) and not right.id in FUNCTIONS and _get_number(left) is not None:
+                cuts.append((right.id, FLIPPED_COMPARISONS[op], _get_number(left)))
+
+    return cuts
+
+def may_pass_cuts(cuts, get_min_max):
+    """
+    Return False if no event with branch values in the ranges given by
+    get_min_max can pass the cuts from get_selection_cuts
+    get_min_max: function that returns the minimum and the maximum of a
+                 branch given its name, or None if they are unknown
+    """
+    for bname, op, value in cuts:
+        min_max = get_min_max(bname)
+        if min_max is None:
+            continue
+
+        # comparisons with nan are False, so nothing is ruled out by them
+        vmin, vmax = min_max
+        if op == '>' and vmax <= value:
+            return False
+        elif op == '>=' and vmax < value:
+            return False
+        elif op == '<' and vmin >= value:
+            return False
+        elif op == '<=' and vmin > value:
+            return False
+        elif op == '==' and (value < vmin or value > vmax):
+            return False
+
+    return True
@@ -0,0 +1,318 @@
+import numpy as np
+from scipy import sparse
+
+# Histogramming with precomputed bin indices
+#
+# A variable array is digitized once. Histograms for any number of weight
+# vectors are then computed from the bin indices with a single weighted
+# bincount or a product with a sparse one-hot matrix, instead of binning the
+# variable again for every weight vector.
+#
+# Bins follow the convention of np.histogram: all bins are half-open except
+# the last one, which includes the upper edge. Entries outside the bin edges
+# are dropped.
+
+def get_bin_index_type(nbins):
+    # int16 if possible, otherwise int32
+    return np.int16 if nbins < np.iinfo(np.int16).max else np.int32
+
+def get_bin_indices(x, bin_edges):
+    """
+    Return the bin index of each entry of x, or -1 if it is outside the bins
+    """
+    bin_edges = np.asarray(bin_edges)
+    nbins = len(bin_edges) - 1
+    dtype = get_bin_index_type(nbins)
+
+    indices = np.searchsorted(bin_edges, x, side='right') - 1
+    # include the upper edge in the last bin
+    indices[x == bin_edges[-1]] = nbins - 1
+    # overflow and nan
+    indices[indices >= nbins] = -1
+
+    return indices.astype(dtype)
+
+def get_one_hot_matrix(bin_indices, nbins):
+    """
+    Return a sparse matrix of shape (n_events, n_bins) with one entry of 1 per
+    event in the column of its bin
+    """
+    events = np.flatnonzero(bin_indices >= 0)
+    return sparse.csr_matrix((np.ones(len(events)), (events, bin_indices[events])), shape=(len(bin_indices), nbins))
+
+def histogram_bin_indices(bin_indices, nbins, weights):
+    """
+    Compute histograms from bin indices
+    weights: array of shape (n_events,), or (..., n_events) for several weight
+             vectors at once, e.g. (n_resamples, n_iterations, n_events)
+    Return the sums of weights and the sums of squared weights, both of the
+    shape (n_bins,) or (..., n_bins), in double precision
+    """
+    weights = np.asarray(weights)
+    assert(weights.shape[-1] == len(bin_indices))
+
+    if weights.ndim == 1:
+        inrange = bin_indices >= 0
+        indices = bin_indices[inrange]
+        w = weights[inrange].astype(np.float64)
+        sumw = np.bincount(indices, weights=w, minlength=nbins)
+        sumw2 = np.bincount(indices, weights=w*w, minlength=nbins)
+        return sumw, sumw2
+
+    # one sparse matrix product for all weight vectors
+    onehot_T = get_one_hot_matrix(bin_indices, nbins).T.tocsr()
+    w = weights.reshape(-1, len(bin_indices)).astype(np.float64).T
+    sumw = (onehot_T @ w).T
+    sumw2 = (onehot_T @ (w*w)).T
+
+    shape = weights.shape[:-1] + (nbins,)
+    return sumw.reshape(shape), sumw2.reshape(shape)
+
+def response_bin_indices(indices_reco, nbins_reco, indices_truth, nbins_truth, weights, sparse_output=False):
+    """
+    Compute response matrices from reco and truth bin indices of the same events
+    weights: array of shape (n_events,), or (..., n_events) for one response
+             per weight vector, e.g. (n_resamples, n_events)
+    Return the sums of weights of the shape (n_bins_reco, n_bins_truth), or
+    (..., n_bins_reco, n_bins_truth), in double precision
+    If sparse_output is True, return a scipy.sparse csr matrix instead, or a
+    list of them if weights has more than one dimension
+    Events outside the bins on either axis are dropped, as in np.histogram2d
+    """
+    weights = np.asarray(weights)
+    assert(len(indices_reco) == len(indices_truth))
+    assert(weights.shape[-1] == len(indices_reco))
+
+    # flat index of the 2D bin
+    events = np.flatnonzero((indices_reco >= 0) & (indices_truth >= 0))
+    ireco = indices_reco[events]
+    itruth = indices_truth[events]
+    shape2d = (nbins_reco, nbins_truth)
+
+    if sparse_output:
+        ws = weights.reshape(-1, len(indices_reco))[:, events].astype(np.float64)
+        # duplicate entries are summed when converted to csr
+        responses = [sparse.coo_matrix((w, (ireco, itruth)), shape=shape2d).tocsr() for w in ws]
+        return responses[0] if weights.ndim == 1 else responses
+
+    flat = ireco.astype(np.int64) * nbins_truth + itruth
+
+    if weights.ndim == 1:
+        w = weights[events].astype(np.float64)
+        return np.bincount(flat, weights=w, minlength=nbins_reco*nbins_truth).reshape(shape2d)
+
+    # one sparse matrix product for all weight vectors
+    onehot_T = sparse.csr_matrix((np.ones(len(events)), (flat, events)), shape=(nbins_reco*nbins_truth, len(indices_reco)))
+    w = weights.reshape(-1, len(indices_reco)).astype(np.float64).T
+    r = (onehot_T @ w).T
+
+    return r.reshape(weights.shape[:-1] + shape2d)
+
+def normalize_histograms(bin_edges, hists, hists_err=None):
+    """
+    Normalize histograms of the shape (n_bins,) or (..., n_bins) in place
+    so that each integrates to one
+    """
+    binwidths = np.diff(bin_edges)
+    norm = (hists @ binwidths)[..., np.newaxis]
+    hists /= norm
+    if hists_err is not None:
+        hists_err /= norm
+
+###########
+# Streaming accumulators
+#
+# Histograms that are filled one block of events at a time, e.g. while
+# iterating over the chunks of a dataset. Partial histograms filled by
+# different threads or processes can be merged, which gives the same result as
+# filling one histogram with all events. They can be converted to a dictionary
+# of arrays or saved to an npz file to be sent between processes.
+#
+# Underflow and overflow are kept in two extra bins at both ends of each axis,
+# i.e. the arrays of sums have n_bins+2 entries along an axis. NaN entries are
+# dropped.
+
+def get_flow_bin_indices(x, bin_edges, bin_indices=None):
+    """
+    Return the bin index of each entry of x counting the underflow bin as 0
+    and the overflow bin as n_bins+1, or -1 for nan
+    bin_indices: the output of get_bin_indices(x, bin_edges) if already known
+    """
+    bin_edges = np.asarray(bin_edges)
+    nbins = len(bin_edges) - 1
+    if bin_indices is None:
+        bin_indices = get_bin_indices(x, bin_edges)
+
+    flow_indices = bin_indices.astype(get_bin_index_type(nbins+2)) + 1
+    flow_indices[x < bin_edges[0]] = 0
+    flow_indices[x > bin_edges[-1]] = nbins + 1
+    flow_indices[np.isnan(x)] = -1
+
+    return flow_indices
+
+class Histogram1D(object):
+    """
+    Mergeable 1D histogram of sums of weights and sums of squared weights
+    shape: shape of the stack of histograms filled with weights of the shape
+           shape+(n_events,), e.g. (n_resamples,). Default: a single histogram
+    """
+    def __init__(self, bin_edges, shape=()):
+        self.bin_edges = np.asarray(bin_edges, dtype=np.float64)
+        self.shape = tuple(shape)
+        nbins = len(self.bin_edges) - 1
+        self.sumw = np.zeros(self.shape+(nbins+2,))
+        self.sumw2 = np.zeros(self.shape+(nbins+2,))
+
+    @property
+    def nbins(self):
+        return len(self.bin_edges) - 1
+
+    def fill(self, x, weights=1., bin_indices=None):
+        """
+        Add a block of events
+        weights: a scalar or an array of the shape self.shape+(len(x),)
+        bin_indices: the output of get_bin_indices(x, self.bin_edges) if
+                     already known, e.g. from a cache
+        """
+        flow_indices = get_flow_bin_indices(x, self.bin_edges, bin_indices)
+        return self.fill_flow_indices(flow_indices, weights)
+
+    def fill_flow_indices(self, flow_indices, weights=1.):
+        """
+        Add a block of events given the output of get_flow_bin_indices, which
+        can be computed once and reused for all fills of the same events
+        """
+        weights = np.broadcast_to(weights, self.shape+(len(flow_indices),))
+        sumw, sumw2 = histogram_bin_indices(flow_indices, self.nbins+2, weights)
+        self.sumw += sumw
+        self.sumw2 += sumw2
+        return self
+
+    def merge(self, other):
+        """
+        Add the content of another histogram with the same bins
+        """
+        if not np.array_equal(self.bin_edges, other.bin_edges) or self.shape != other.shape:
+            raise RuntimeError("Cannot merge histograms with different bins or shapes")
+        self.sumw += other.sumw
+        self.sumw2 += other.sumw2
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    @property
+    def underflow(self):
+        return self.sumw[..., 0]
+
+    @property
+    def overflow(self):
+        return self.sumw[..., -1]
+
+    def get_histogram(self, normalize=False):
+        """
+        Return the histograms and their errors without underflow and overflow
+        """
+        hist = self.sumw[..., 1:-1].copy()
+        hist_err = np.sqrt(self.sumw2[..., 1:-1])
+        if normalize:
+            normalize_histograms(self.bin_edges, hist, hist_err)
+        return hist, hist_err
+
+    def to_dict(self):
+        return {'bin_edges': self.bin_edges, 'sumw': self.sumw, 'sumw2': self.sumw2}
+
+    @classmethod
+    def from_dict(cls, hdict):
+        h = cls(hdict['bin_edges'], shape=np.shape(hdict['sumw'])[:-1])
+        h.sumw[...] = hdict['sumw']
+        h.sumw2[...] = hdict['sumw2']
+        return h
+
+    def save(self, file_name):
+        np.savez_compressed(file_name, **self.to_dict())
+
+    @classmethod
+    def load(cls, file_name):
+        with np.load(file_name) as f:
+            return cls.from_dict(f)
+
+class Histogram2D(object):
+    """
+    Mergeable 2D histogram of sums of weights and sums of squared weights,
+    e.g. a response matrix with the reco variable on the x axis and the truth
+    variable on the y axis
+    shape: shape of the stack of histograms as in Histogram1D
+    """
+    def __init__(self, bin_edges_x, bin_edges_y, shape=()):
+        self.bin_edges_x = np.asarray(bin_edges_x, dtype=np.float64)
+        self.bin_edges_y = np.asarray(bin_edges_y, dtype=np.float64)
+        self.shape = tuple(shape)
+        nbins_x = len(self.bin_edges_x) - 1
+        nbins_y = len(self.bin_edges_y) - 1
+        self.sumw = np.zeros(self.shape+(nbins_x+2, nbins_y+2))
+        self.sumw2 = np.zeros(self.shape+(nbins_x+2, nbins_y+2))
+
+    @property
+    def nbins(self):
+        return len(self.bin_edges_x) - 1, len(self.bin_edges_y) - 1
+
+    def fill(self, x, y, weights=1., bin_indices_x=None, bin_indices_y=None):
+        """
+        Add a block of events
+        weights: a scalar or an array of the shape self.shape+(len(x),)
+        bin_indices_x, bin_indices_y: the outputs of get_bin_indices for x and
+                                      y if already known
+        """
+        flow_indices_x = get_flow_bin_indices(x, self.bin_edges_x, bin_indices_x)
+        flow_indices_y = get_flow_bin_indices(y, self.bin_edges_y, bin_indices_y)
+        return self.fill_flow_indices(flow_indices_x, flow_indices_y, weights)
+
+    def fill_flow_indices(self, flow_indices_x, flow_indices_y, weights=1.):
+        """
+        Add a block of events given the outputs of get_flow_bin_indices for x
+        and y
+        """
+        weights = np.broadcast_to(weights, self.shape+(len(flow_indices_x),))
+        nbins_x, nbins_y = self.nbins
+        self.sumw += response_bin_indices(flow_indices_x, nbins_x+2, flow_indices_y, nbins_y+2, weights)
+        self.sumw2 += response_bin_indices(flow_indices_x, nbins_x+2, flow_indices_y, nbins_y+2, weights*weights)
+        return self
+
+    def merge(self, other):
+        """
+        Add the content of another histogram with the same bins
+        """
+        if not np.array_equal(self.bin_edges_x, other.bin_edges_x) or not np.array_equal(self.bin_edges_y, other.bin_edges_y) or self.shape != other.shape:
+            raise RuntimeError("Cannot merge histograms with different bins or shapes")
+        self.sumw += other.sumw
+        self.sumw2 += other.sumw2
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def get_histogram(self):
+        """
+        Return the 2D histograms and their errors without underflow and
+        overflow, as np.histogram2d
+        """
+        return self.sumw[..., 1:-1, 1:-1].copy(), np.sqrt(self.sumw2[..., 1:-1, 1:-1])
+
+    def to_dict(self):
+        return {'bin_edges_x': self.bin_edges_x, 'bin_edges_y': self.bin_edges_y, 'sumw': self.sumw, 'sumw2': self.sumw2}
+
+    @classmethod
+    def from_dict(cls, hdict):
+        h = cls(hdict['bin_edges_x'], hdict['bin_edges_y'], shape=np.shape(hdict['sumw'])[:-2])
+        h.sumw[...] = hdict['sumw']
+        h.sumw2[...] = hdict['sumw2']
+        return h
+
+    def save(self, file_name):
+        np.savez_compressed(file_name, **self.to_dict())
+
+    @classmethod
+    def load(cls, file_name):
+        with np.load(file_name) as f:
+            return cls.from_dict(f)
@@ -2,13 +2,16 @@ import os
 import numpy as np
 import pandas as pd
 
-import external.OmniFold.modplot as modplot
 import plotting
 from util import add_histograms
+from histogramming import get_flow_bin_indices, Histogram1D, Histogram2D
 import logging
 logger = logging.getLogger('IBU')
 logger.setLevel(logging.DEBUG)
 
+# maximum number of resampled event weights held in memory at once
+MAX_RESAMPLE_ENTRIES = 2**22
+
 class IBU(object):
     def __init__(self, varname, bins_det, bins_mc, obs, sim, gen, simbkg=None, wobs=1., wsig=1., wbkg=1., iterations=4, nresample=25, outdir='.'):
         # variable name
@@ -24,6 +27,12 @@ class IBU(object):
         self.array_gen = gen
         # ndarray of variable in background simulation at the detector level
         self.array_bkg = simbkg
+        # bin indices of the arrays including underflow and overflow bins
+        # computed once for all histograms and resamples
+        self.indices_obs = get_flow_bin_indices(obs, bins_det)
+        self.indices_sim = get_flow_bin_indices(sim, bins_det)
+        self.indices_gen = get_flow_bin_indices(gen, bins_mc)
+        self.indices_bkg = None if simbkg is None else get_flow_bin_indices(simbkg, bins_det)
         # event weights
         self.weights_obs = wobs
         self.weights_sig = wsig
@@ -44,21 +53,40 @@ class IBU(object):
         r = self._response_matrix(self.weights_sig, plot=True)
 
         # unfold
-        self.hists_unfolded = self._unfold(r, self.weights_obs, self.weights_sig, self.weights_bkg)
+        # bin errors propagated from the observed distribution
+        self.hists_unfolded, self.hists_unfolded_err = self._unfold(r, self.weights_obs, self.weights_sig, self.weights_bkg)
 
         # bin uncertainty and correlation
-        self.hists_unfolded_err, self.hists_unfolded_corr = self._uncertainty(
-            self.nresamples, response=r, resample_obs=True, resample_sig=False)
+        if self.nresamples > 1:
+            self.hists_unfolded_err, self.hists_unfolded_corr = self._uncertainty(
+                self.nresamples, response=r, resample_obs=True, resample_sig=False)
+        else:
+            logger.warn("  Unable to compute bootstrap uncertainty with {} resamples. Use errors propagated from the observed distribution instead.".format(self.nresamples))
+            self.hists_unfolded_corr = None
 
     def get_unfolded_distribution(self, all_iterations=False):
         if all_iterations:
             return self.hists_unfolded, self.hists_unfolded_err, self.hists_unfolded_corr
         else:
-            return self.hists_unfolded[-1], self.hists_unfolded_err[-1], self.hists_unfolded_corr[-1]
+            corr = None if self.hists_unfolded_corr is None else self.hists_unfolded_corr[-1]
+            return self.hists_unfolded[-1], self.hists_unfolded_err[-1], corr
+
+    def _response_matrix(self, weights_sim, plot=True, nresamples=None, seed=None):
+        """
+        If nresamples is provided, return a response matrix for each of the
+        nresamples sets of resampled simulation weights, of the shape
+        (n_resamples, n_bins_det, n_bins_mc)
+        """
+        if nresamples is None:
+            hr = Histogram2D(self.bins_det, self.bins_mc)
+            hr.fill_flow_indices(self.indices_sim, self.indices_gen, weights_sim)
+        else:
+            hr = Histogram2D(self.bins_det, self.bins_mc, shape=(nresamples,))
+            for rows, w in self._resampled_weights(weights_sim, len(self.array_sim), nresamples, seed):
+                hr.fill_flow_indices(self.indices_sim[rows], self.indices_gen[rows], w)
 
-    def _response_matrix(self, weights_sim, plot=True):
-        r = np.histogram2d(self.array_sim, self.array_gen, bins=(self.bins_det, self.bins_mc), weights=weights_sim)[0]
-        r /= (r.sum(axis=0) + 10**-50)
+        r = hr.get_histogram()[0]
+        r /= (r.sum(axis=-2)[..., np.newaxis, :] + 10**-50)
 
         if plot:
             figname = os.path.join(self.outdir, 'Response_{}'.format(self.varname))
@@ -71,59 +99,143 @@ class IBU(object):
         ######
         # detector level
         # observed distribution
-        hist_obs, hist_obs_err = modplot.calc_hist(self.array_obs, weights=weights_obs, bins=self.bins_det, density=False)[:2]
+        hist_obs, hist_obs_err = self._histogram(self.indices_obs, self.bins_det, weights_obs, density=False)
 
         # if background is not none, subtract background
         if self.array_bkg is not None:
-            hist_bkg, hist_bkg_err = modplot.calc_hist(self.array_bkg, weights=weights_bkg, bins=self.bins_det)[:2]
+            hist_bkg, hist_bkg_err = self._histogram(self.indices_bkg, self.bins_det, weights_bkg)
             hist_obs, hist_obs_err = add_histograms(hist_obs, hist_bkg, hist_obs_err, hist_bkg_err, c1=1., c2=-1.)
 
         ######
         # truth level
         # prior distribution
-        hist_prior, hist_prior_err = modplot.calc_hist(self.array_gen, weights=weights_sig, bins=self.bins_mc)[:2]
-
+        hist_prior, hist_prior_err = self._histogram(self.indices_gen, self.bins_mc, weights_sig)
+
+        return self._iterate(response, hist_obs, hist_prior, hist_obs_err, hist_prior_err) # shape: (n_iteration, nbins_hist)
+
+    def _iterate(self, response, hist_obs, hist_prior, hist_obs_err=None, hist_prior_err=None):
+        """
+        Run the Bayesian iterations
+        The inputs can be stacks of histograms and response matrices with the
+        same leading dimensions, e.g. one for each resample, which are all
+        unfolded at once
+        Return the prior and the unfolded distributions of all iterations,
+        of the shape (..., n_iterations+1, n_bins_mc), and their errors
+        propagated from hist_obs_err, or None if hist_obs_err is not provided
+        The propagated errors ignore the dependence of the unfolding matrix
+        on the observed distribution.
+        """
         # bin widths
         wbins_det = self.bins_det[1:] - self.bins_det[:-1]
         wbins_mc = self.bins_mc[1:] - self.bins_mc[:-1]
 
         # start iterations
         hists_ibu = [hist_prior]
+        hists_ibu_err = [hist_prior_err]
 
         for i in range(self.iterations):
             # update the estimate given the response matrix and the latest unfolded distribution
-            m = response * hists_ibu[-1]
-            m /= (m.sum(axis=1)[:,np.newaxis] + 10**-50)
+            m = response * hists_ibu[-1][..., np.newaxis, :]
+            m /= (m.sum(axis=-1)[..., np.newaxis] + 10**-50)
 
             # update the unfolded given m and the observed distribution
-            hists_ibu.append(np.dot(m.T, hist_obs)*wbins_det/wbins_mc)
-
-        return hists_ibu # shape: (n_iteration, nbins_hist)
+            hists_ibu.append(np.einsum('...dt,...d->...t', m, hist_obs)*wbins_det/wbins_mc)
+
+            if hist_obs_err is not None:
+                hists_ibu_err.append(np.sqrt(np.einsum('...dt,...d->...t', m*m, hist_obs_err**2))*wbins_det/wbins_mc)
+
+        hists_ibu = np.stack(np.broadcast_arrays(*hists_ibu), axis=-2)
+        if hist_obs_err is None:
+            return hists_ibu, None
+
+        hists_ibu_err[0] = np.zeros_like(hist_prior) if hist_prior_err is None else hist_prior_err
+        return hists_ibu, np.stack(np.broadcast_arrays(*hists_ibu_err), axis=-2)
+
+    def _histogram(self, flow_indices, bins, weights, density=True, nresamples=None, seed=None):
+        """
+        If nresamples is provided, return the histograms of nresamples sets
+        of resampled weights, of the shape (n_resamples, n_bins)
+        """
+        if nresamples is None:
+            h = Histogram1D(bins)
+            h.fill_flow_indices(flow_indices, weights)
+            wsum = np.broadcast_to(weights, flow_indices.shape).sum()
+        else:
+            h = Histogram1D(bins, shape=(nresamples,))
+            wsum = np.zeros(nresamples)
+            for rows, w in self._resampled_weights(weights, len(flow_indices), nresamples, seed):
+                h.fill_flow_indices(flow_indices[rows], w)
+                wsum += w.sum(axis=-1)
+
+        hist, hist_err = h.get_histogram()
+
+        if density:
+            # same normalization as modplot.calc_hist: by the sum of all
+            # weights, including those of events outside the bins
+            density_int = np.asarray(wsum)[..., np.newaxis] * (bins[1] - bins[0])
+            hist /= density_int
+            hist_err /= density_int
+
+        return hist, hist_err
+
+    def _resampled_weights(self, weights, nevents, nresamples, seed=None):
+        """
+        Iterate over blocks of events
+        Yield the slice of the block and the weights multiplied by Poisson
+        random numbers with mean 1, of the shape (n_resamples, n_events_block)
+        The same seed gives the same random numbers. If it is None, a seed is
+        drawn from the global numpy random state.
+        """
+        if seed is None:
+            seed = np.random.randint(np.iinfo(np.int32).max)
+        rng = np.random.RandomState(seed)
+        weights = np.broadcast_to(weights, (nevents,))
+        block_size = max(MAX_RESAMPLE_ENTRIES // nresamples, 1)
+        for istart in range(0, nevents, block_size):
+            rows = slice(istart, min(istart+block_size, nevents))
+            yield rows, weights[rows] * rng.poisson(1, size=(nresamples, rows.stop-rows.start))
 
     def _uncertainty(self, nresamples, response=None, resample_obs=True, resample_sig=True):
-        hists_resample = []
+        if not nresamples > 1:
+            raise RuntimeError("At least two resamples are needed to compute the bootstrap uncertainty")
 
-        for iresample in range(nresamples):
-            # resample the weights
-            reweights_obs = self.weights_obs * np.random.poisson(1, size=len(self.array_obs)) if resample_obs else self.weights_obs
-            reweights_sig = self.weights_sig * np.random.poisson(1, size=len(self.array_gen)) if resample_sig else self.weights_sig
+        # all resamples are unfolded at once
+        # observed distributions
+        if resample_obs:
+            hist_obs = self._histogram(self.indices_obs, self.bins_det, self.weights_obs, density=False, nresamples=nresamples)[0]
+        else:
+            hist_obs = self._histogram(self.indices_obs, self.bins_det, self.weights_obs, density=False)[0]
 
-            # recompute response with resampled simulation weights if needed
+        if self.array_bkg is not None:
+            hist_bkg = self._histogram(self.indices_bkg, self.bins_det, self.weights_bkg)[0]
+            hist_obs = hist_obs - hist_bkg
+
+        # prior distributions
+        # the response is computed from the same resampled weights as the prior
+        # if it is not provided
+        if resample_sig:
+            seed_sig = np.random.randint(np.iinfo(np.int32).max)
+            hist_prior = self._histogram(self.indices_gen, self.bins_mc, self.weights_sig, nresamples=nresamples, seed=seed_sig)[0]
+            if response is None:
+                response = self._response_matrix(self.weights_sig, plot=False, nresamples=nresamples, seed=seed_sig)
+        else:
+            hist_prior = self._histogram(self.indices_gen, self.bins_mc, self.weights_sig)[0]
             if response is None:
-                response = self._response_matrix(reweights_sig, plot=False)
+                response = self._response_matrix(self.weights_sig, plot=False)
 
-            hists_resample.append(self._unfold(response, reweights_obs, reweights_sig, self.weights_bkg))
+        hists_resample = self._iterate(response, hist_obs, hist_prior)[0]
+        # shape: (n_resamples, n_iterations, n_bins)
+        hists_resample = np.broadcast_to(hists_resample, (nresamples,)+hists_resample.shape[-2:])
 
         # standard deviation of each bin
-        errors = np.std(np.asarray(hists_resample), axis=0, ddof=1) # shape: (n_iteration, nbins_hist)
+        errors = np.std(hists_resample, axis=0, ddof=1) # shape: (n_iteration, nbins_hist)
 
         # bin correlations
         corrs = []
-        # np.asarray(hists_resample) shape: (n_resamples, n_iterations, n_bins)
         # for each iteration
         for i in range(self.iterations):
-            df_ihist = pd.DataFrame(np.asarray(hists_resample)[:,i,:])
-            corrs.append(df_ihist.corr())
-            #assert( np.allclose(np.sqrt(np.asarray([df_ihist.cov()[i][i] for i in range(len(df_ihist.columns))])), errors[i]) ) # sanity check
+            # nan for bins without variation, as pandas
+            with np.errstate(divide='ignore', invalid='ignore'):
+                corrs.append(pd.DataFrame(np.corrcoef(hists_resample[:,i,:], rowvar=False)))
 
         return errors, corrs
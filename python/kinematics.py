@@ -0,0 +1,118 @@
+import numpy as np
+
+# Vectorized four-vector kinematics for ttbar observables
+#
+# Observables of the ttbar system are computed from the components of the
+# hadronic (th) and the leptonic (tl) top quarks stored in the input ntuples:
+#   {prefix}_pt{suffix}, {prefix}_eta{suffix}, {prefix}_phi{suffix}, {prefix}_m{suffix}
+# e.g. th_pt_klfitter or tl_eta_MC
+#
+# In observable configs, such a variable is referred to as 'tt:<observable>'
+# or 'tt:<observable>:<suffix>', e.g.
+#   "branch_det": "tt:mtt:_klfitter", "branch_mc": "tt:mtt:_MC"
+
+KINEMATICS_PREFIX = 'tt:'
+
+class FourVectorArray(object):
+    """
+    Arrays of four-vectors in Cartesian components
+    """
+    def __init__(self, px, py, pz, e):
+        self.px = px
+        self.py = py
+        self.pz = pz
+        self.e = e
+
+    @classmethod
+    def from_ptetaphim(cls, pt, eta, phi, m):
+        px = pt * np.cos(phi)
+        py = pt * np.sin(phi)
+        pz = pt * np.sinh(eta)
+        e = np.sqrt(px*px + py*py + pz*pz + m*m)
+        return cls(px, py, pz, e)
+
+    def __add__(self, other):
+        return FourVectorArray(self.px + other.px, self.py + other.py,
+                               self.pz + other.pz, self.e + other.e)
+
+    @property
+    def pt(self):
+        return np.hypot(self.px, self.py)
+
+    @property
+    def phi(self):
+        return np.arctan2(self.py, self.px)
+
+    @property
+    def m(self):
+        m2 = self.e*self.e - self.px*self.px - self.py*self.py - self.pz*self.pz
+        # protect against small negative values from rounding
+        return np.sqrt(np.maximum(m2, 0.))
+
+    @property
+    def y(self):
+        # rapidity
+        return 0.5 * np.log((self.e + self.pz) / (self.e - self.pz))
+
+def delta_phi(phi1, phi2):
+    # absolute azimuthal angle difference in [0, pi]
+    dphi = np.abs(phi1 - phi2)
+    return np.where(dphi > np.pi, 2*np.pi - dphi, dphi)
+
+def pout(p4, p4_ref):
+    """
+    Momentum of p4 perpendicular to the plane spanned by p4_ref and the beam axis
+    """
+    return (p4.px * p4_ref.py - p4.py * p4_ref.px) / p4_ref.pt
+
+# ttbar observables as functions of the hadronic and the leptonic top four-vectors
+TTBAR_OBSERVABLES = {
+    'mtt': lambda th, tl: (th + tl).m,
+    'ptt': lambda th, tl: (th + tl).pt,
+    'ytt': lambda th, tl: (th + tl).y,
+    'ystar': lambda th, tl: 0.5 * (th.y - tl.y),
+    'chitt': lambda th, tl: np.exp(np.abs(th.y - tl.y)),
+    'yboost': lambda th, tl: 0.5 * (th.y + tl.y),
+    'dphi': lambda th, tl: delta_phi(th.phi, tl.phi),
+    'Ht': lambda th, tl: th.pt + tl.pt,
+    'th_pout': lambda th, tl: pout(th, tl),
+    'tl_pout': lambda th, tl: pout(tl, th),
+}
+
+def is_kinematic_variable(variable):
+    return variable.startswith(KINEMATICS_PREFIX)
+
+def parse_kinematic_variable(variable):
+    """
+    Return the observable name and the branch suffix of a 'tt:' variable
+    """
+    fields = variable[len(KINEMATICS_PREFIX):].split(':')
+    observable = fields[0]
+    suffix = fields[1] if len(fields) > 1 else ''
+
+    if not observable in TTBAR_OBSERVABLES:
+        raise RuntimeError("Unknown kinematic observable {}. \nAvailable observables: {}".format(observable, list(TTBAR_OBSERVABLES)))
+
+    return observable, suffix
+
+def get_component_names(prefix, suffix=''):
+    return ['{}_{}{}'.format(prefix, comp, suffix) for comp in ['pt', 'eta', 'phi', 'm']]
+
+def get_kinematic_components(variable):
+    """
+    Return the list of branch names needed to compute a 'tt:' variable
+    """
+    suffix = parse_kinematic_variable(variable)[1]
+    return get_component_names('th', suffix) + get_component_names('tl', suffix)
+
+def compute_kinematic_variable(variable, get_arr):
+    """
+    Compute a 'tt:' variable
+    get_arr: function that returns the array of a branch given its name
+    """
+    observable, suffix = parse_kinematic_variable(variable)
+
+    th = FourVectorArray.from_ptetaphim(*[get_arr(b) for b in get_component_names('th', suffix)])
+    tl = FourVectorArray.from_ptetaphim(*[get_arr(b) for b in get_component_names('tl', suffix)])
+
+    return TTBAR_OBSERVABLES[observable](th, tl)
@@ -1,3 +1,5 @@
+import math
+import numpy as np
 from tensorflow import keras
 from tensorflow.keras import layers
 
@@ -32,8 +34,10 @@ def get_model(input_shape, nclass=2):
     model.add(layers.Dense(100, activation='relu', kernel_initializer='he_uniform'))
     model.add(layers.Dense(nclass, activation='softmax', kernel_initializer='he_uniform'))
 
+    # labels are integer class indices, e.g. int8 arrays, instead of one-hot
+    # vectors. Same loss as categorical_crossentropy for one-hot labels.
     model.compile(
-        loss='categorical_crossentropy',
+        loss='sparse_categorical_crossentropy',
         optimizer='adam',
         metrics=['accuracy']
     )
@@ -41,3 +45,89 @@ def get_model(input_shape, nclass=2):
     model.summary()
 
     return model
+
+class EventSequence(keras.utils.Sequence):
+    """
+    Batches of a dataset given by the indices of its entries, so that the
+    training and validation sets do not need to be copied out of the arrays
+    Entry i is labelled Y[i] with weight w[i]. Its features are X[i], or
+    X[events[i]] if events is provided, e.g. to map several entries to the
+    same row of X. X can be memory-mapped, in which case only the rows of a
+    batch are read from disk.
+    """
+    def __init__(self, X, Y, w, indices, batch_size=256, shuffle=True, events=None):
+        """
+        indices: entries of the dataset to iterate over
+        """
+        super().__init__()
+        if Y is not None:
+            assert(len(Y)==len(w))
+            assert(len(Y)==(len(X) if events is None else len(events)))
+        self.X = X
+        self.Y = Y
+        self.w = w
+        self.events = events
+        self.indices = np.array(indices)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+        if self.shuffle:
+            np.random.shuffle(self.indices)
+
+    def __len__(self):
+        return math.ceil(len(self.indices) / self.batch_size)
+
+    def get_entries(self, indices=None):
+        """
+        Return the event indices in X, the labels and the weights of entries
+        of the dataset
+        """
+        if indices is None:
+            indices = self.indices
+        events = indices if self.events is None else self.events[indices]
+        return events, self.Y[indices], self.w[indices]
+
+    def __getitem__(self, ibatch):
+        batch = self.indices[ibatch*self.batch_size:(ibatch+1)*self.batch_size]
+        events, labels, w = self.get_entries(batch)
+
+        return self.X[events], labels, w
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.indices)
+
+class PairedEventSequence(EventSequence):
+    """
+    Batches of a dataset that consists of two copies of the same events with
+    different weights: events labelled 1 with weights w1 and events labelled
+    0 with weights w0
+    Only one copy of the feature array X is kept. Entries i < len(X) of the
+    virtual dataset are the events X[i] labelled 1, entries i >= len(X) are
+    the events X[i-len(X)] labelled 0.
+    """
+    def __init__(self, X, w1, w0, indices, batch_size=256, shuffle=True):
+        """
+        indices: entries of the virtual dataset of size 2*len(X) to iterate over
+        """
+        assert(len(w1)==len(X) and len(w0)==len(X))
+        super().__init__(X, None, None, indices, batch_size, shuffle)
+        self.w1 = w1
+        self.w0 = w0
+
+    def get_events_and_labels(self, indices=None):
+        """
+        Return the event indices in X and the labels of entries of the virtual
+        dataset
+        """
+        if indices is None:
+            indices = self.indices
+        labels = (indices < len(self.X)).astype(np.int8)
+        return indices % len(self.X), labels
+
+    def get_weights(self, events, labels):
+        return np.where(labels==1, self.w1[events], self.w0[events])
+
+    def get_entries(self, indices=None):
+        events, labels = self.get_events_and_labels(indices)
+        return events, labels, self.get_weights(events, labels)
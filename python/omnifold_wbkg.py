@@ -210,8 +210,8 @@ class OmniFoldwBkg(object):
         if standardize: # standardize X
             self.X_det = (self.X_det - np.mean(self.X_det, axis=0)) / np.std(self.X_det, axis=0)
 
-        # make Y categorical
-        self.Y_det = tf.keras.utils.to_categorical(self.Y_det)
+        # labels are class indices for the sparse categorical loss
+        self.Y_det = self.Y_det.astype(np.int8)
 
     def _preprocess_gen(self, dataset_sig, standardize=True):
         """ Set self.X_gen, self.Y_gen
@@ -226,9 +226,9 @@ class OmniFoldwBkg(object):
         if standardize: # standardize X
             self.X_gen = (self.X_gen - np.mean(self.X_gen, axis=0)) / np.std(self.X_gen, axis=0)
 
-        # make Y categorical
+        # labels are class indices for the sparse categorical loss
         nsim = len(X_gen_sig)
-        self.Y_gen = tf.keras.utils.to_categorical(np.concatenate([np.ones(nsim), np.zeros(nsim)]))
+        self.Y_gen = np.concatenate([np.ones(nsim, dtype=np.int8), np.zeros(nsim, dtype=np.int8)])
 
     def _rescale_event_weights(self):
         # standardize data sample weights
@@ -2,13 +2,12 @@ import os
 import glob
 import numpy as np
 import pandas as pd
-import tensorflow as tf
-from sklearn.model_selection import train_test_split
 
 import plotting
 from datahandler import DataHandler
-from model import get_model, get_callbacks
-from util import add_histograms, write_chi2
+from model import get_model, get_callbacks, EventSequence, PairedEventSequence
+from util import add_histograms, write_chi2, SegmentedArray
+from util import DataShufflerDet, DataShufflerGen
 import logging
 logger = logging.getLogger('OmniFoldwBkg')
 logger.setLevel(logging.DEBUG)
@@ -33,9 +32,16 @@ class OmniFoldwBkg(object):
         # arrays for training
         self.X_step1 = None
         self.Y_step1 = None
-        self.X_step2 = None
-        self.Y_step2 = None
+        # segments of the entries for step 1: obs, sim, bkg
+        self.segments_step1 = None
+        # rows of X_step1 of the entries, or None if they are the same
+        self.events_step1 = None
+        # training and validation splits, fixed for all iterations and resamples
+        self.splitter_step1 = None
+        self.splitter_step2 = None
         # arrays for reweigting
+        # X_sim is a view of X_step1
+        # X_gen is used for both classes in step 2 training
         self.X_sim = None
         self.X_gen = None
         # nominal event weights from samples
@@ -45,6 +51,9 @@ class OmniFoldwBkg(object):
         # unfoled weights
         self.unfolded_weights = None
         self.unfolded_weights_resample = None
+        # histograms for the results
+        # keyed by sample name, variable name and bin edges
+        self.histograms = {}
         # output directory
         if not os.path.isdir(outdir):
             os.makedirs(outdir)
@@ -82,12 +91,13 @@ class OmniFoldwBkg(object):
         self._set_arrays_step1(self.datahandle_obs, self.datahandle_sig, self.datahandle_bkg, standardize)
 
         # arrays for step 2
-        # self.X_step2, self.Y_step2, self.X_gen
+        # self.X_gen
         self._set_arrays_step2(self.datahandle_sig, standardize)
 
         # event weights for training
         self._set_event_weights(rw_type=reweight_type, vars_dict=vars_dict,
                                 rescale=True)
+        self.histograms = {}
 
     def run(self, error_type='sumw2', nresamples=0, load_previous_iteration=True,
             batch_size=256, epochs=100):
@@ -96,6 +106,9 @@ class OmniFoldwBkg(object):
 
         fitargs = {'batch_size': batch_size, 'epochs': epochs, 'verbose': 1}
 
+        # histograms of previous results are outdated
+        self.histograms = {}
+
         self.unfolded_weights = self._unfold(load_previous_iter=load_previous_iteration, fname_event_weights='weights.npz', **fitargs)
 
         # bootstrap uncertainty
@@ -106,6 +119,9 @@ class OmniFoldwBkg(object):
         # load unfolded event weights from the saved file
         logger.info("Skip training")
 
+        # histograms of previous results are outdated
+        self.histograms = {}
+
         wfilelist = list(unfolded_weight_files)
         assert(len(wfilelist) > 0)
         logger.info("Load unfolded weights: {}".format(wfilelist[0]))
@@ -120,8 +136,10 @@ class OmniFoldwBkg(object):
 
     def get_unfolded_distribution(self, variable, bins, all_iterations=False,
                                   bootstrap_uncertainty=True, normalize=True):
-        ws = self.unfolded_weights if all_iterations else self.unfolded_weights[-1]
-        hist_uf, hist_uf_err = self.datahandle_sig.get_histogram(variable, ws, bins)
+        # histograms of all iterations
+        hist_uf, hist_uf_err = self._get_histogram('unfolded', variable, bins)
+        if not all_iterations:
+            hist_uf, hist_uf_err = hist_uf[-1], hist_uf_err[-1]
 
         bin_corr = None # bin correlations
         if bootstrap_uncertainty:
@@ -132,25 +150,87 @@ class OmniFoldwBkg(object):
 
         if normalize:
             # renormalize the unfolded histograms and its error to the nominal signal simulation weights
-            hist_uf *= self.weights_sim.sum() / self.unfolded_weights[-1].sum()
-            hist_uf_err *= self.weights_sim.sum() / self.unfolded_weights[-1].sum()
+            # not in place: the histograms are cached
+            hist_uf = hist_uf * self.weights_sim.sum() / self.unfolded_weights[-1].sum()
+            hist_uf_err = hist_uf_err * self.weights_sim.sum() / self.unfolded_weights[-1].sum()
             # all iterations are rescaled based on the weights of the last one
             # renormalize histograms of each iteration according to their individual norm instead?
 
         return hist_uf, hist_uf_err, bin_corr
 
+    def fill_histograms(self, observables):
+        """
+        Compute the histograms of all observables for the results at once,
+        with one pass over the events for each set of weights
+        observables: list of (varConfig, bins_det, bins_mc)
+                     bins_det or bins_mc can be None to skip that level
+        """
+        vars_bins_det = [(varConfig['branch_det'], bins_det) for varConfig, bins_det, _ in observables if bins_det is not None]
+        vars_bins_mc = [(varConfig['branch_mc'], bins_mc) for varConfig, _, bins_mc in observables if bins_mc is not None]
+
+        truth_known = self.datahandle_obs is not None and self.datahandle_obs.truth_known
+
+        requests = [
+            ('obs', vars_bins_det + (vars_bins_mc if truth_known else [])),
+            ('sim', vars_bins_det + vars_bins_mc),
+            ('bkg', vars_bins_det + (vars_bins_mc if truth_known else [])),
+            ('unfolded', vars_bins_mc),
+            ('resample', vars_bins_mc)
+            ]
+
+        for sample, vars_bins in requests:
+            handle, weights = self._get_sample(sample)
+            if handle is None or weights is None or not vars_bins:
+                continue
+
+            logger.debug("Fill histograms of {} {} observables".format(len(vars_bins), sample))
+            for (variable, bins), hist in zip(vars_bins, handle.get_histograms(vars_bins, weights)):
+                self.histograms[self._get_histogram_key(sample, variable, bins)] = hist
+
+    def _get_sample(self, sample):
+        # data handler and event weights of each sample
+        if sample == 'obs':
+            return self.datahandle_obs, self.weights_obs
+        elif sample == 'sim':
+            return self.datahandle_sig, self.weights_sim
+        elif sample == 'bkg':
+            return self.datahandle_bkg, self.weights_bkg
+        elif sample == 'unfolded':
+            # shape: (n_iterations+1, n_events)
+            return self.datahandle_sig, self.unfolded_weights
+        elif sample == 'resample':
+            # shape: (n_resamples, n_iterations+1, n_events)
+            return self.datahandle_sig, self.unfolded_weights_resample
+        else:
+            raise RuntimeError("Unknown sample {}".format(sample))
+
+    def _get_histogram_key(self, sample, variable, bins):
+        return (sample, variable, np.asarray(bins, dtype=np.float64).tobytes())
+
+    def _get_histogram(self, sample, variable, bins):
+        """
+        Return the histogram and its error of a variable in a sample
+        from the ones filled by fill_histograms if available
+        """
+        key = self._get_histogram_key(sample, variable, bins)
+        if not key in self.histograms:
+            handle, weights = self._get_sample(sample)
+            self.histograms[key] = handle.get_histogram(variable, weights, bins)
+
+        return self.histograms[key]
+
     def plot_distributions_reco(self, varname, varConfig, bins):
         # observed
-        hist_obs, hist_obs_err = self.datahandle_obs.get_histogram(varConfig['branch_det'], self.weights_obs, bins)
+        hist_obs, hist_obs_err = self._get_histogram('obs', varConfig['branch_det'], bins)
 
         # signal simulation
-        hist_sim, hist_sim_err = self.datahandle_sig.get_histogram(varConfig['branch_det'], self.weights_sim, bins)
+        hist_sim, hist_sim_err = self._get_histogram('sim', varConfig['branch_det'], bins)
 
         # background simulation
         if self.datahandle_bkg is None:
             hist_simbkg, hist_simbkg_err = None, None
         else:
-            hist_simbkg, hist_simbkg_err = self.datahandle_bkg.get_histogram(varConfig['branch_det'], self.weights_bkg, bins)
+            hist_simbkg, hist_simbkg_err = self._get_histogram('bkg', varConfig['branch_det'], bins)
 
         # plot
         figname = os.path.join(self.outdir, 'Reco_{}'.format(varname))
@@ -171,15 +251,15 @@ class OmniFoldwBkg(object):
             hist_ibu, hist_ibu_err, hist_ibu_corr = None, None, None
 
         # signal prior distribution
-        hist_gen, hist_gen_err = self.datahandle_sig.get_histogram(varConfig['branch_mc'], self.weights_sim, bins)
+        hist_gen, hist_gen_err = self._get_histogram('sim', varConfig['branch_mc'], bins)
 
         # MC truth if known
         if self.datahandle_obs.truth_known:
-            hist_truth, hist_truth_err = self.datahandle_obs.get_histogram(varConfig['branch_mc'], self.weights_obs, bins)
+            hist_truth, hist_truth_err = self._get_histogram('obs', varConfig['branch_mc'], bins)
 
             # subtract background if needed
             if self.datahandle_bkg is not None:
-                hist_genbkg, hist_genbkg_err = self.datahandle_bkg.get_histogram(varConfig['branch_mc'], self.weights_bkg, bins)
+                hist_genbkg, hist_genbkg_err = self._get_histogram('bkg', varConfig['branch_mc'], bins)
                 hist_truth, hist_truth_err = add_histograms(hist_truth, hist_genbkg, hist_truth_err, hist_genbkg_err, c1=1., c2=-1.)
         else:
             hist_truth, hist_truth_err = None, None
@@ -210,7 +290,7 @@ class OmniFoldwBkg(object):
             plotting.plot_correlations(hist_ibu_corr, figname_ibu_corr)
 
         # plot all resampled unfolded distributions
-        if plot_resamples:
+        if plot_resamples and self.unfolded_weights_resample is not None:
             hists_resample = self._get_unfolded_hists_resample(varConfig['branch_mc'], bins, all_iterations=False)
             figname_resamples = os.path.join(self.outdir, 'Unfold_AllResamples_{}'.format(varname))
             plotting.plot_hists_resamples(figname_resamples, bins, hists_resample, hist_gen, **varConfig)
@@ -253,10 +333,19 @@ class OmniFoldwBkg(object):
 
         ################
         # start iterations
-        ws_t = np.empty(shape=(self.iterations+1, len(wsim)))
+        ws_t = np.empty(shape=(self.iterations+1, len(wsim)), dtype=wsim.dtype)
         ## shape: (n_iterations+1, n_events)
         ws_t[0,:] = wsim
 
+        # weight arrays for training with the same segments as the labels
+        # only the segments that change are updated in each iteration
+        w_step1 = self.segments_step1.empty_like(dtype=wsim.dtype)
+        if not reweight_only and self.splitter_step1 is None:
+            self._split_training_data(val_size)
+        w_step1['obs'] = wobs
+        if wbkg is not None:
+            w_step1['bkg'] = wbkg
+
         for i in range(self.iterations):
             logger.info("Iteration {}".format(i))
             ####
@@ -269,19 +358,19 @@ class OmniFoldwBkg(object):
             wm_push_i = ws_t[i] # for i=0, this is wsim
 
             if not reweight_only:
-                # prepare weight array for training
-                if wbkg is None:
-                    w_step1 = np.concatenate([wobs, wm_push_i])
-                else:
-                    w_step1 = np.concatenate([wobs, wm_push_i, wbkg])
-                assert(len(w_step1)==len(self.X_step1))
+                # update the simulation weights for training
+                w_step1['sim'] = wm_push_i
+                assert(len(w_step1)==len(self.Y_step1))
 
-                # split data into training and test sets
-                X_step1_train, X_step1_test, Y_step1_train, Y_step1_test, w_step1_train, w_step1_test = train_test_split(self.X_step1, self.Y_step1, w_step1, test_size=val_size)
+                # training and validation sets
+                # batches are gathered from X_step1 by index, so the split
+                # does not copy the features
+                seq_step1_train = EventSequence(self.X_step1, self.Y_step1, w_step1.array, self.splitter_step1.get_train_indices(), fitargs['batch_size'], events=self.events_step1)
+                seq_step1_val = EventSequence(self.X_step1, self.Y_step1, w_step1.array, self.splitter_step1.get_val_indices(), fitargs['batch_size'], shuffle=False, events=self.events_step1)
 
                 logger.info("Start training")
                 fname_preds1 = model_dir+'/preds_step1_{}'.format(i) if model_dir else None
-                self._train_model(model_step1, X_step1_train, Y_step1_train, w_step1_train, callbacks=cb_step1, val_data=(X_step1_test, Y_step1_test, w_step1_test), figname_preds=fname_preds1, **fitargs)
+                self._train_model(model_step1, seq_step1_train, seq_step1_val, callbacks=cb_step1, figname_preds=fname_preds1, **fitargs)
 
             # reweight
             logger.info("Reweighting")
@@ -296,22 +385,22 @@ class OmniFoldwBkg(object):
             # step 2: reweight the simulation prior to the learned weights
             logger.info("Step 2")
             # set up the model for iteration i
-            model_step2, cb_step2 = self._set_up_model_step2(self.X_step2.shape[1:], i, model_dir, reweight_only, load_previous_iter)
+            model_step2, cb_step2 = self._set_up_model_step2(self.X_gen.shape[1:], i, model_dir, reweight_only, load_previous_iter)
 
             # pull the learned weights from detector level to the truth level
             wt_pull_i = wm_i
 
             if not reweight_only:
-                # prepare weight array for training
-                w_step2 = np.concatenate([wt_pull_i, ws_t[i]])
-
-                # split data into training and test sets
-                X_step2_train, X_step2_test, Y_step2_train, Y_step2_test, w_step2_train, w_step2_test = train_test_split(self.X_step2, self.Y_step2, w_step2, test_size=val_size)
+                # training and validation sets
+                # the events are labelled 1 with the pulled weights and 0 with
+                # the prior weights. Both are mapped to X_gen by index.
+                seq_step2_train = PairedEventSequence(self.X_gen, wt_pull_i, ws_t[i], self.splitter_step2.get_train_indices(), fitargs['batch_size'])
+                seq_step2_test = PairedEventSequence(self.X_gen, wt_pull_i, ws_t[i], self.splitter_step2.get_val_indices(), fitargs['batch_size'], shuffle=False)
 
                 # train model
                 logger.info("Start training")
                 fname_preds2 = model_dir+'/preds_step2_{}'.format(i) if model_dir else None
-                self._train_model(model_step2, X_step2_train, Y_step2_train, w_step2_train, callbacks=cb_step2, val_data=(X_step2_test, Y_step2_test, w_step2_test), figname_preds=fname_preds2, **fitargs)
+                self._train_model(model_step2, seq_step2_train, seq_step2_test, callbacks=cb_step2, figname_preds=fname_preds2, **fitargs)
 
             # reweight
             logger.info("Reweighting")
@@ -377,7 +466,7 @@ class OmniFoldwBkg(object):
                                                             all_iterations)
 
         hists_err, hists_corr = None, None
-        if hists_resample:
+        if len(hists_resample) > 0:
             hists_err = np.std(np.asarray(hists_resample), axis=0, ddof=1)
             # shape = (n_iteration, n_bins) if all_iterations
             # otherwise, shape = (n_bins,)
@@ -401,17 +490,12 @@ class OmniFoldwBkg(object):
         return  hists_err, hists_corr
 
     def _get_unfolded_hists_resample(self, variable, bins, all_iterations=False):
-        hists_resample = []
-        for iresample in range(len(self.unfolded_weights_resample)):
-            if all_iterations:
-                ws = self.unfolded_weights_resample[iresample]
-            else:
-                ws = self.unfolded_weights_resample[iresample][-1]
+        # histograms of all resamples
+        # shape: (n_resamples, n_iterations+1, n_bins) if all_iterations
+        # otherwise, shape = (n_resamples, n_bins)
+        hists_resample = self._get_histogram('resample', variable, bins)[0]
 
-            hist = self.datahandle_sig.get_histogram(variable, ws, bins)[0]
-            hists_resample.append(hist)
-
-        return hists_resample
+        return hists_resample if all_iterations else hists_resample[:,-1,:]
 
     def _read_weights_from_file(self, weights_file, array_name='weights'):
         # load unfolded weights from saved file
@@ -420,53 +504,127 @@ class OmniFoldwBkg(object):
         wfile.close()
         return weights
 
+    def _split_training_data(self, val_size=0.2):
+        # split the training data once for all iterations and resamples
+        # only the indices of the training and validation sets are kept
+        logger.info("Split training and validation data")
+        self.splitter_step1 = DataShufflerDet(len(self.Y_step1), val_size)
+
+        # an event and its copy are either both in the training set or both
+        # in the validation set
+        self.splitter_step2 = DataShufflerGen(2*len(self.X_gen), val_size)
+
     def _set_arrays_step1(self, obsHandle, simHandle, bkgHandle=None, standardize=True):
         # step 1: observed data vs simulation at detector level
-        X_obs, Y_obs = obsHandle.get_dataset(self.vars_reco, self.label_obs, standardize=False)
-        X_sim, Y_sim = simHandle.get_dataset(self.vars_reco, self.label_sig, standardize=False)
-
-        if bkgHandle is None:
-            self.X_step1 = np.concatenate([X_obs, X_sim])
-            self.Y_step1 = np.concatenate([Y_obs, Y_sim])
+        nobs = obsHandle.get_nevents()
+        nsim = simHandle.get_nevents()
+        nbkg = 0 if bkgHandle is None else bkgHandle.get_nevents()
+
+        # same samples, e.g. closure tests: the observed entries use the
+        # simulation features, which are only stored once
+        closure = obsHandle.data is simHandle.data
+
+        # labels of the entries: obs, sim, bkg
+        # class indices for the sparse categorical loss
+        self.segments_step1 = SegmentedArray([('obs', nobs), ('sim', nsim), ('bkg', nbkg)], dtype=np.int8)
+        self.segments_step1['obs'] = self.label_obs
+        self.segments_step1['sim'] = self.label_sig
+        self.segments_step1['bkg'] = self.label_bkg
+        self.Y_step1 = self.segments_step1.array
+
+        # fill the segments of one feature array instead of concatenating
+        # X_sim is a view of the simulation segment
+        # in the chunked mode, the array is a memory-mapped file in the output
+        # directory, so training batches are read from disk
+        chunk_size = simHandle.chunk_size
+        fname_features = os.path.join(self.outdir, 'features_step1.npy') if chunk_size else None
+        features = SegmentedArray([('obs', 0 if closure else nobs), ('sim', nsim), ('bkg', nbkg)], shape=(len(self.vars_reco),), dtype=simHandle.vtype, filename=fname_features)
+        self.X_step1 = features.array
+        self.X_sim = features['sim']
+
+        simHandle.get_dataset(self.vars_reco, self.label_sig, standardize=False, out=self.X_sim)
+        if closure:
+            # map the observed entries to the rows of the simulation segment
+            self.events_step1 = np.concatenate([np.arange(nsim), np.arange(len(self.X_step1))])
         else:
-            X_simbkg, Y_simbkg = bkgHandle.get_dataset(self.vars_reco, self.label_bkg, standardize=False)
-            self.X_step1 = np.concatenate([X_obs, X_sim, X_simbkg])
-            self.Y_step1 = np.concatenate([Y_obs, Y_sim, Y_simbkg])
-
-        self.X_sim = X_sim
+            self.events_step1 = None
+            obsHandle.get_dataset(self.vars_reco, self.label_obs, standardize=False, out=features['obs'])
 
-        # make Y categorical
-        self.Y_step1 = tf.keras.utils.to_categorical(self.Y_step1)
+        if bkgHandle is not None:
+            bkgHandle.get_dataset(self.vars_reco, self.label_bkg, standardize=False, out=features['bkg'])
 
         if standardize:
-            Xmean = np.mean(self.X_step1, axis=0)
-            Xstd = np.std(self.X_step1, axis=0)
+            # X_sim is standardized together with X_step1
+            if closure:
+                # rows of the simulation segment are used twice
+                nentries = np.ones(len(self.X_step1))
+                nentries[features.segments['sim']] = 2
+            else:
+                nentries = None
+            Xmean, Xstd = self._get_mean_std(self.X_step1, nentries, chunk_size)
             self.X_step1 -= Xmean
             self.X_step1 /= Xstd
-            self.X_sim -= Xmean
-            self.X_sim /= Xstd
 
         logger.info("Size of the feature array for step 1: {:.3f} MB".format(self.X_step1.nbytes*2**-20))
+        if fname_features:
+            logger.info("Feature array for step 1 is memory-mapped from {}".format(fname_features))
         logger.info("Size of the label array for step 1: {:.3f} MB".format(self.Y_step1.nbytes*2**-20))
 
     def _set_arrays_step2(self, simHandle, standardize=True):
         # step 2: update simulation weights at truth level
-        self.X_gen = simHandle.get_dataset(self.vars_truth, self.label_sig, standardize=False)[0]
-        nsim = len(self.X_gen)
-
-        self.X_step2 = np.concatenate([self.X_gen, self.X_gen])
-        self.Y_step2 = tf.keras.utils.to_categorical(np.concatenate([np.ones(nsim), np.zeros(nsim)]))
+        # the two classes have the same features and only differ in weights
+        # keep one copy of them and map both classes to it in training
+        # memory-mapped from the output directory in the chunked mode
+        chunk_size = simHandle.chunk_size
+        fname_features = os.path.join(self.outdir, 'features_step2.npy') if chunk_size else None
+        out = None
+        if fname_features:
+            out = np.lib.format.open_memmap(fname_features, mode='w+', dtype=simHandle.vtype, shape=(simHandle.get_nevents(), len(self.vars_truth)))
+        self.X_gen = simHandle.get_dataset(self.vars_truth, self.label_sig, standardize=False, out=out)[0]
 
         if standardize:
-            Xmean = np.mean(self.X_step2, axis=0)
-            Xstd = np.std(self.X_step2, axis=0)
-            self.X_step2 -= Xmean
-            self.X_step2 /= Xstd
+            # same as the mean and std of the two copies
+            Xmean, Xstd = self._get_mean_std(self.X_gen, None, chunk_size)
             self.X_gen -= Xmean
             self.X_gen /= Xstd
 
-        logger.info("Size of the feature array for step 2: {:.3f} MB".format(self.X_step2.nbytes*2**-20))
-        logger.info("Size of the label array for step 2: {:.3f} MB".format(self.Y_step2.nbytes*2**-20))
+        logger.info("Size of the feature array for step 2: {:.3f} MB".format(self.X_gen.nbytes*2**-20))
+        if fname_features:
+            logger.info("Feature array for step 2 is memory-mapped from {}".format(fname_features))
+
+    def _get_mean_std(self, X, weights=None, chunk_size=None):
+        """
+        Return the (weighted) mean and standard deviation of the columns of X
+        Computed in double precision and returned in the type of X
+        If chunk_size is provided, X is read block by block to avoid full-size
+        temporary arrays, e.g. if it is memory-mapped
+        """
+        if not chunk_size:
+            if weights is None:
+                Xmean = np.mean(X, axis=0, dtype=np.float64)
+                Xstd = np.std(X, axis=0, dtype=np.float64)
+            else:
+                Xmean = np.average(X, axis=0, weights=weights)
+                Xstd = np.sqrt(np.average((X - Xmean)**2, axis=0, weights=weights))
+            return Xmean.astype(X.dtype), Xstd.astype(X.dtype)
+
+        blocks = [slice(istart, istart+chunk_size) for istart in range(0, len(X), chunk_size)]
+        sumw, sumwx, sumwx2 = 0., 0., 0.
+        for rows in blocks:
+            Xb = X[rows].astype(np.float64)
+            wb = np.ones(len(Xb)) if weights is None else weights[rows]
+            sumw += wb.sum()
+            sumwx += wb @ Xb
+        Xmean = sumwx / sumw
+
+        # second pass for the variance
+        for rows in blocks:
+            Xb = X[rows].astype(np.float64) - Xmean
+            wb = np.ones(len(Xb)) if weights is None else weights[rows]
+            sumwx2 += wb @ (Xb*Xb)
+        Xstd = np.sqrt(sumwx2 / sumw)
+
+        return Xmean.astype(X.dtype), Xstd.astype(X.dtype)
 
     def _set_event_weights(self, rw_type=None, vars_dict={}, rescale=True):
         self.weights_obs = self.datahandle_obs.get_weights(rw_type=rw_type,
@@ -493,12 +651,12 @@ class OmniFoldwBkg(object):
     def _get_event_weights(self, normalize=False, resample=False):
         wobs = self.weights_obs
         wsim = self.weights_sim
-        wbkg = self.weights_bkg if self.weights_bkg else None
+        wbkg = self.weights_bkg
 
         if normalize: # normalize to len(weights)
             wobs = wobs / np.mean(wobs)
             wsim = wsim / np.mean(wsim)
-            if wbkg:
+            if wbkg is not None:
                 wbkg = wbkg / np.mean(wbkg)
 
         if resample:
@@ -562,23 +720,32 @@ class OmniFoldwBkg(object):
             else:
                 return self._set_up_model(input_shape, filepath_save=model_fp.format(iteration), filepath_load=None)
 
-    def _train_model(self, model, X, Y, w, callbacks=[], val_data=None, figname_preds='', **fitargs):
+    def _train_model(self, model, seq_train, seq_val, callbacks=[], figname_preds='', **fitargs):
+        # batches are provided by the sequences
+        fitargs.pop('batch_size', None)
         if callbacks:
             fitargs.setdefault('callbacks', []).extend(callbacks)
 
-        val_dict = {'validation_data': val_data} if val_data is not None else {}
-
-        model.fit(X, Y, sample_weight=w, **fitargs, **val_dict)
+        model.fit(seq_train, validation_data=seq_val, **fitargs)
 
         if figname_preds:
-            preds_train = model.predict(X, batch_size=int(0.1*len(X)))[:,1]
-            X_val, Y_val, w_val = val_data
-            preds_val = model.predict(X_val, batch_size=int(0.1*len(X_val)))[:,1]
+            # entries that map to the same event have the same prediction
+            preds = self._predict(model, seq_train.X)[:,1]
+            events_t, Y_t, w_t = seq_train.get_entries()
+            events_v, Y_v, w_v = seq_val.get_entries()
             logger.info("Plot model output distribution: {}".format(figname_preds))
-            plotting.plot_training_vs_validation(figname_preds, preds_train, Y, w, preds_val, Y_val, w_val)
+            plotting.plot_training_vs_validation(figname_preds, preds[events_t], Y_t, w_t, preds[events_v], Y_v, w_v)
+
+    def _predict(self, model, X):
+        # one batch of a tenth of the events at a time
+        # memory-mapped features are only read one batch at a time
+        batch_size = max(int(0.1*len(X)), 1)
+        return np.concatenate([model.predict(X[istart:istart+batch_size], batch_size=batch_size) for istart in range(0, len(X), batch_size)])
 
     def _reweight(self, model, events, plotname=None):
-        preds = model.predict(events, batch_size=int(0.1*len(events)))[:,1]
+        # model outputs are in single precision. Upcast before computing the
+        # ratio since 10**-50 underflows in float32
+        preds = self._predict(model, events)[:,1].astype(np.float64)
         r = preds / (1. - preds + 10**-50)
 
         if plotname: # plot the ratio distribution
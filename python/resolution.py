@@ -2,17 +2,29 @@ import numpy as np
 from scipy.optimize import curve_fit
 
 from plotting import plot_graphs
+from histogramming import get_bin_indices, response_bin_indices
 
 from util import getLogger
 logger = getLogger('Resolution', level=20)
 
-def resolution(reco_arr, truth_arr, weights, bins_reco, bins_truth, figname=None, xlabel=''):
+def resolution(reco_arr, truth_arr, weights, bins_reco, bins_truth, figname=None, xlabel='', indices_reco=None, indices_truth=None):
     """
     compute resolutions given reco and truth variables
     return a function that outputs resolution for a given truth value
+    indices_reco, indices_truth: bin indices of the variables if already
+                                 computed, e.g. by histogramming.get_bin_indices
     """
+    xbins = np.asarray(bins_reco)
+    ybins = np.asarray(bins_truth)
+
+    if indices_reco is None:
+        indices_reco = get_bin_indices(reco_arr, xbins)
+    if indices_truth is None:
+        indices_truth = get_bin_indices(truth_arr, ybins)
+
     # migration matrix
-    hist2d, xbins, ybins = np.histogram2d(reco_arr, truth_arr, bins=(bins_reco, bins_truth), weights=weights)
+    # sparse, since most entries are far from the diagonal for fine bins
+    hist2d = response_bin_indices(indices_reco, len(xbins)-1, indices_truth, len(ybins)-1, weights, sparse_output=True).tocsc()
     # bin errors?
 
     # look at the reco variable (x) distribution in each slice of truth value (y)
@@ -24,7 +36,7 @@ def resolution(reco_arr, truth_arr, weights, bins_reco, bins_truth, figname=None
 
     for ybin in range(len(bins_truth)-1):
         value_truth = midbins_y[ybin]
-        hist_reco = hist2d[:,ybin]
+        hist_reco = hist2d[:,ybin].toarray().ravel()
         #hist_reco_err = hist2d_err[:,ybin]
 
         # in case there is no entries in the histogram
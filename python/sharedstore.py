@@ -0,0 +1,131 @@
+import os
+import hashlib
+import numpy as np
+from multiprocessing import shared_memory
+
+from util import parse_input_name
+
+# Registry of dataset columns in named shared memory
+#
+# The first process that reads a column publishes it into a shared memory
+# segment. Later processes on the same node attach to the segment instead of
+# reading the input files again. Attached arrays are read-only.
+#
+# Segments are named after a hash of the input files (including their
+# modification times and reweighting factors), the event selection, the
+# branch name and the array type. They are kept after the processes exit and
+# need to be removed with clear_shared_store().
+
+SEGMENT_PREFIX = 'topunf_'
+
+# Each segment starts with a header: [ready flag, number of events]
+HEADER_SIZE = 64 # bytes
+
+# keep references to the open segments so that their buffers stay mapped
+_open_segments = []
+
+def _open_segment(name, create=False, size=0):
+    try:
+        # python >= 3.13: do not let the resource tracker unlink the segment
+        # when this process exits
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+def get_dataset_key(file_names, selection=None, array_name='arr_0'):
+    """
+    Return a string that identifies a dataset read from file_names
+    """
+    if not isinstance(file_names, list):
+        file_names = [file_names]
+
+    keys = []
+    for fname in file_names:
+        fn, rwfactor = parse_input_name(fname)
+        fn = os.path.abspath(fn)
+        keys.append('{}:{}:{}'.format(fn, os.path.getmtime(fn), rwfactor))
+
+    keys.append('selection:{}'.format(selection))
+    keys.append('array:{}'.format(array_name))
+
+    return ';'.join(keys)
+
+def get_segment_name(dataset_key, variable, dtype):
+    digest = hashlib.sha1('{}|{}|{}'.format(dataset_key, variable, np.dtype(dtype).str).encode()).hexdigest()
+    # POSIX shared memory names are limited to 31 characters on some platforms
+    return SEGMENT_PREFIX + digest[:24]
+
+def attach_column(dataset_key, variable, dtype):
+    """
+    Return a read-only array of a published column, or None if it is not
+    available (yet)
+    """
+    try:
+        shm = _open_segment(get_segment_name(dataset_key, variable, dtype))
+    except FileNotFoundError:
+        return None
+
+    header = np.ndarray(2, dtype=np.int64, buffer=shm.buf)
+    if header[0] != 1:
+        # still being written by another process
+        del header
+        shm.close()
+        return None
+
+    arr = np.ndarray(int(header[1]), dtype=dtype, buffer=shm.buf, offset=HEADER_SIZE)
+    arr.flags.writeable = False
+    _open_segments.append(shm)
+
+    return arr
+
+def publish_column(dataset_key, variable, arr):
+    """
+    Copy arr into a new shared memory segment
+    Return a read-only array backed by the segment
+    If the column has been published by another process in the meantime,
+    return that one or arr itself if it is not ready yet
+    """
+    name = get_segment_name(dataset_key, variable, arr.dtype)
+    try:
+        shm = _open_segment(name, create=True, size=HEADER_SIZE+max(arr.nbytes, 1))
+    except FileExistsError:
+        arr_shared = attach_column(dataset_key, variable, arr.dtype)
+        return arr if arr_shared is None else arr_shared
+
+    header = np.ndarray(2, dtype=np.int64, buffer=shm.buf)
+    header[1] = len(arr)
+
+    arr_shared = np.ndarray(len(arr), dtype=arr.dtype, buffer=shm.buf, offset=HEADER_SIZE)
+    arr_shared[:] = arr
+    arr_shared.flags.writeable = False
+
+    # mark as ready
+    header[0] = 1
+
+    _open_segments.append(shm)
+
+    return arr_shared
+
+def clear_shared_store(shm_dir='/dev/shm'):
+    """
+    Remove all published segments
+    Return the number of segments removed
+    """
+    if not os.path.isdir(shm_dir):
+        return 0
+
+    nremoved = 0
+    for name in os.listdir(shm_dir):
+        if not name.startswith(SEGMENT_PREFIX):
+            continue
+
+        # open with tracking, which unlink() undoes
+        shm = shared_memory.SharedMemory(name=name)
+        shm.close()
+        shm.unlink()
+        nremoved += 1
+
+    return nremoved
@@ -277,10 +277,16 @@ class DataShufflerDet(object):
 
     def shuffle_and_split(self, arr):
         assert(len(arr)==len(self.perm))
-        arr_train = arr[self.perm[:-self.nval]]
-        arr_val = arr[self.perm[-self.nval:]]
+        arr_train = arr[self.get_train_indices()]
+        arr_val = arr[self.get_val_indices()]
         return arr_train, arr_val
 
+    def get_train_indices(self):
+        return self.perm[:len(self.perm)-self.nval]
+
+    def get_val_indices(self):
+        return self.perm[len(self.perm)-self.nval:]
+
     def unshuffle(self, arr):
         assert(len(arr)==len(self.invperm))
         return arr[self.invperm]
@@ -312,6 +318,42 @@ class DataShufflerGen(DataShufflerDet):
         self.perm = np.concatenate((trainperm, valperm))
         self.invperm = np.argsort(self.perm)
 
+# One array made of named segments along the first axis
+# Segments are views into the array, so filling a segment fills the array
+# without concatenation
+class SegmentedArray(object):
+    def __init__(self, segments, shape=(), dtype=np.float64, filename=None):
+        """
+        segments: list of (name, number of rows)
+        shape: shape of each row
+        filename: if provided, the array is a memory-mapped .npy file
+        """
+        self.segments = {}
+        istart = 0
+        for name, size in segments:
+            self.segments[name] = slice(istart, istart+size)
+            istart += size
+
+        if filename:
+            self.array = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=(istart,)+tuple(shape))
+        else:
+            self.array = np.empty((istart,)+tuple(shape), dtype=dtype)
+
+    def __getitem__(self, name):
+        return self.array[self.segments[name]]
+
+    def __setitem__(self, name, value):
+        self.array[self.segments[name]] = value
+
+    def __len__(self):
+        return len(self.array)
+
+    def empty_like(self, shape=(), dtype=np.float64):
+        """
+        Return a new SegmentedArray with the same segments
+        """
+        return SegmentedArray([(name, s.stop-s.start) for name, s in self.segments.items()], shape, dtype)
+
 def compute_triangular_discr(histogram_1, histogram_2):
     if len(histogram_1) != len(histogram_2):
         raise RuntimeError("Input histograms are not of the same size")
@@ -0,0 +1,14 @@
+#!/usr/bin/env python3
+import argparse
+
+from sharedstore import clear_shared_store
+
+parser = argparse.ArgumentParser(description='Remove the input arrays published in shared memory by unfold.py --shared-memory')
+
+parser.add_argument('--shm-dir', dest='shm_dir', default='/dev/shm',
+                    help='directory of the POSIX shared memory segments')
+
+args = parser.parse_args()
+
+nremoved = clear_shared_store(args.shm_dir)
+print("Removed {} shared memory segments".format(nremoved))
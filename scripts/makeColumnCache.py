@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+import argparse
+
+from datahandler import write_columnar_cache
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('inputs', nargs='+', type=str,
+                    help='input npz files')
+parser.add_argument('-o', '--output', required=True, type=str,
+                    help='output cache directory')
+parser.add_argument('--array-name', dest='array_name', default='arr_0',
+                    help='name of the structured array in the npz files')
+
+args = parser.parse_args()
+
+manifest = write_columnar_cache(args.inputs, args.output, args.array_name)
+print("Columnar cache created: {} ({} events, {} branches)".format(args.output, manifest['nevents'], len(manifest['fields'])))
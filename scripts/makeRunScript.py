@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import json
+import shlex
 import argparse
 
 parser = argparse.ArgumentParser()
@@ -80,7 +81,19 @@ def get_argument_str(argname, argvalue):
         else:
             return ''
     else:
-        return '--'+argname+' '+str(argvalue)
+        return '--'+argname+' '+get_value_str(argvalue)
+
+def get_value_str(argvalue):
+    argvalue = str(argvalue)
+    words = argvalue.split()
+    if words and all(shlex.quote(w) == w for w in words):
+        # plain words, e.g. a space-separated list of observables, are passed
+        # as separate arguments
+        return argvalue
+    else:
+        # anything with shell syntax, e.g. an event selection, is passed as
+        # one quoted argument
+        return shlex.quote(argvalue)
 
 def get_label_str(keyname, argvalue):
     if isinstance(argvalue, bool):
@@ -149,4 +162,9 @@ for testname, testConfig in runConfig['tests'].items():
         out_str = ' -o ./output_'+testLabel+pl+'_'+testname
         f_run.write(run_str + opt + out_str + '\n')
 
+# release the input arrays shared between the runs
+if runConfig['parameters'].get('shared-memory', False):
+    f_run.write("###########\n")
+    f_run.write("python3 scripts/clearSharedStore.py\n")
+
 f_run.close()
@@ -64,20 +64,43 @@ def unfold(**parsed_args):
     logger.info("Loading datasets")
     t_data_start = time.time()
 
+    # if unfolded weights are provided, only read branches when they are needed
+    lazy = bool(parsed_args['unfolded_weights'])
+
     # collision data
     fnames_obs = parsed_args['data']
     data_obs = DataHandler(fnames_obs, wname,
                             truth_known=parsed_args['truth_known'],
-                            variable_names = vars_det_all+vars_mc_all)
+                            variable_names = vars_det_all+vars_mc_all,
+                            chunk_size = parsed_args['chunk_size'],
+                            io_workers = parsed_args['io_workers'],
+                            vtype = parsed_args['feature_precision'],
+                            wtype = parsed_args['weight_precision'],
+                            selection = parsed_args['selection'],
+                            lazy = lazy,
+                            shared = parsed_args['shared_memory'],
+                            precompute = parsed_args['precompute'])
                             #vars_dict = observable_dict
 
     # signal simulation
     fnames_sig = parsed_args['signal']
-    data_sig = DataHandler(fnames_sig, wname, variable_names = vars_det_all+vars_mc_all) #vars_dict = observable_dict
+    if data_obs.has_inputs(fnames_sig, parsed_args['selection']):
+        # e.g. closure tests: share the arrays instead of reading them twice
+        logger.info("Observed data and signal simulation are the same samples")
+        data_sig = data_obs.share(truth_known=True)
+    else:
+        data_sig = DataHandler(fnames_sig, wname, variable_names = vars_det_all+vars_mc_all, chunk_size = parsed_args['chunk_size'], io_workers = parsed_args['io_workers'], vtype = parsed_args['feature_precision'], wtype = parsed_args['weight_precision'], selection = parsed_args['selection'], lazy = lazy, shared = parsed_args['shared_memory'], precompute = parsed_args['precompute']) #vars_dict = observable_dict
 
     # background simulation
     fnames_bkg = parsed_args['background']
-    data_bkg =  DataHandler(fnames_bkg, wname, variable_names = vars_det_all+vars_mc_all) if fnames_bkg else None
+    if not fnames_bkg:
+        data_bkg = None
+    elif data_sig.has_inputs(fnames_bkg, parsed_args['selection']):
+        data_bkg = data_sig.share(truth_known=True)
+    elif data_obs.has_inputs(fnames_bkg, parsed_args['selection']):
+        data_bkg = data_obs.share(truth_known=True)
+    else:
+        data_bkg = DataHandler(fnames_bkg, wname, variable_names = vars_det_all+vars_mc_all, chunk_size = parsed_args['chunk_size'], io_workers = parsed_args['io_workers'], vtype = parsed_args['feature_precision'], wtype = parsed_args['weight_precision'], selection = parsed_args['selection'], lazy = lazy, shared = parsed_args['shared_memory'], precompute = parsed_args['precompute'])
 
     t_data_done = time.time()
     logger.info("Loading dataset took {:.2f} seconds".format(t_data_done-t_data_start))
@@ -133,22 +156,35 @@ def unfold(**parsed_args):
     #################
     t_result_start = time.time()
 
+    # bin edges of all observables
+    bins_dict = {}
     for varname in parsed_args['observables']:
-        logger.info("Unfold variable: {}".format(varname))
         varConfig = observable_dict[varname]
 
-        # detector-level distributions
+        # detector level
         bins_det = get_bins(varname, parsed_args['binning_config'])
         if bins_det is None:
             bins_det = np.linspace(varConfig['xlim'][0], varConfig['xlim'][1], varConfig['nbins_det']+1)
 
-        unfolder.plot_distributions_reco(varname, varConfig, bins_det)
-
-        # truth-level distributions
+        # truth level
         bins_mc = get_bins(varname, parsed_args['binning_config'])
         if bins_mc is None:
             bins_mc = np.linspace(varConfig['xlim'][0], varConfig['xlim'][1], varConfig['nbins_mc']+1)
 
+        bins_dict[varname] = (bins_det, bins_mc)
+
+    # histograms of all observables in one pass over each sample
+    logger.info("Fill histograms")
+    unfolder.fill_histograms([(observable_dict[varname],)+bins_dict[varname] for varname in parsed_args['observables']])
+
+    for varname in parsed_args['observables']:
+        logger.info("Unfold variable: {}".format(varname))
+        varConfig = observable_dict[varname]
+        bins_det, bins_mc = bins_dict[varname]
+
+        # detector-level distributions
+        unfolder.plot_distributions_reco(varname, varConfig, bins_det)
+
         # iterative Bayesian unfolding
         if True: # doIBU
             array_obs = data_obs.get_variable_arr(varConfig['branch_det'])
@@ -160,7 +196,7 @@ def unfold(**parsed_args):
                       # use the same weights from OmniFold
                       unfolder.weights_obs, unfolder.weights_sim, unfolder.weights_bkg,
                       iterations=parsed_args['iterations'], # same as OmniFold
-                      nresample=25, #parsed_args['nresamples']
+                      nresample=parsed_args['nresamples'], # same as OmniFold
                       outdir = unfolder.outdir)
             ibu.run()
         else:
@@ -191,16 +227,16 @@ if __name__ == "__main__":
                         help="List of observables to unfold")
     parser.add_argument('-d', '--data', required=True, nargs='+',
                         type=str,
-                        help="Observed data npz file names")
+                        help="Observed data file names (npz, HDF5, Parquet or columnar cache directories)")
     parser.add_argument('--observable-config', dest='observable_config',
                         default='configs/observables/default.json',
                         help="JSON configurations for observables")
     parser.add_argument('-s', '--signal', required=True, nargs='+',
                         type=str,
-                        help="Signal MC npz file names")
+                        help="Signal MC file names (npz, HDF5, Parquet or columnar cache directories)")
     parser.add_argument('-b', '--background', nargs='+',
                         type=str,
-                        help="Background MC npz file names")
+                        help="Background MC file names (npz, HDF5, Parquet or columnar cache directories)")
     parser.add_argument('-o', '--outputdir',
                         default='./output',
                         help="Directory for storing outputs")
@@ -242,6 +278,22 @@ if __name__ == "__main__":
                         default='sumw2', help="Method to evaluate uncertainties")
     parser.add_argument('--batch-size', dest='batch_size', type=int, default=512,
                         help="Batch size for training")
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=None,
+                        help="If provided, process input datasets in blocks of this many events. With columnar caches, the columns are memory-mapped in their stored type and converted block by block, which bounds the memory used to read inputs and fill histograms. The training features are written to memory-mapped files in the output directory, from which the training batches are read. Event weights are still held in memory.")
+    parser.add_argument('--io-workers', dest='io_workers', type=int, default=1,
+                        help="Number of threads for reading input files")
+    parser.add_argument('--feature-precision', dest='feature_precision',
+                        choices=['float32', 'float64'], default='float32',
+                        help="Floating point precision of input features")
+    parser.add_argument('--weight-precision', dest='weight_precision',
+                        choices=['float32', 'float64'], default='float64',
+                        help="Floating point precision of event weights")
+    parser.add_argument('--selection', type=str, default=None,
+                        help="Event selection applied to all samples when reading, e.g. '(mttReco > 500) & (mttTrue > 500)'")
+    parser.add_argument('--precompute', nargs='*', type=str, default=[],
+                        help="Derived variables to compute once when loading the datasets, e.g. th_px th_py")
+    parser.add_argument('--shared-memory', dest='shared_memory', action='store_true',
+                        help="Share the input arrays with other runs on the same node via shared memory. Run scripts/clearSharedStore.py afterwards to release it.")
 
     #parser.add_argument('-n', '--normalize',
     #                    action='store_true',